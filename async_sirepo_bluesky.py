@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+
+import aiohttp
+
+from sirepo_bluesky import PollingPolicy, SirepoBluesky, auth_request
+from timing import PhaseTimings
+
+
+def create_async_session(pool_size=100):
+    """ Create an aiohttp.ClientSession holding up to pool_size keep-alive connections. """
+    connector = aiohttp.TCPConnector(limit=pool_size)
+    # cookies are passed explicitly per request, as each client has its own auth
+    return aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+
+
+class AsyncSirepoBluesky(object):
+    """
+    asyncio counterpart of SirepoBluesky.
+
+    A single event loop can drive many simulations at once: while a
+    simulation is running, run_simulation() awaits between the status calls
+    instead of blocking a process.
+
+    Parameters
+    ----------
+    server: str
+        Sirepo server to call, ex. 'http://locahost:8000'
+    secret: str, optional
+        Secret key shared with the server. Defaults to 'bluesky'.
+    session: aiohttp.ClientSession, optional
+        Session used for all the requests. A pooled session is created on first
+        use if not provided, and closed by close(). Copies returned by
+        copy_sim() share it.
+    pool_size: int, optional
+        Maximum number of simultaneous connections of the created session.
+        Defaults is 100.
+    polling: PollingPolicy, optional
+        Default policy of the status calls made by run_simulation().
+    timings: PhaseTimings, optional
+        Histograms of the durations of the requests, per endpoint, and of
+        the runs ('simulation'). Created if not provided, copies returned by
+        copy_sim() share it.
+    cache: SimulationCache, optional
+        Local cache of the datafiles, see SirepoBluesky.
+
+    Examples
+    --------
+    async def main():
+        async with AsyncSirepoBluesky('http://localhost:8000') as sb:
+            data, schema = await sb.auth('srw', '1tNWph0M')
+            copies = await asyncio.gather(*[sb.copy_sim('Bluesky') for _ in range(100)])
+            for i, c in enumerate(copies):
+                aperture = c.find_element(c.data['models']['beamline'], 'title', 'A1')
+                aperture['horizontalSize'] = 0.1 * (i + 1)
+                watch = c.find_element(c.data['models']['beamline'], 'title', 'W1')
+                c.data['report'] = 'watchpointReport{}'.format(watch['id'])
+            await asyncio.gather(*[c.run_simulation() for c in copies])
+            files = await asyncio.gather(*[c.get_datafile() for c in copies])
+            await asyncio.gather(*[c.delete_copy() for c in copies])
+
+    asyncio.run(main())
+
+    """
+
+    find_element = staticmethod(SirepoBluesky.find_element)
+    find_optic_id_by_name = SirepoBluesky.find_optic_id_by_name
+    # the cache and polling logic of the runs is the same as for the blocking client
+    _start_run = SirepoBluesky._start_run
+    _finish_run = SirepoBluesky._finish_run
+    _datafile_url = SirepoBluesky._datafile_url
+    _store_datafile = SirepoBluesky._store_datafile
+    _write_cached_datafile = SirepoBluesky._write_cached_datafile
+
+    def __init__(self, server, secret='bluesky', session=None, pool_size=100, polling=None, cache=None,
+                 timings=None):
+        self.server = server
+        self.secret = secret
+        self.cache = cache
+        if timings is None:
+            timings = PhaseTimings(server)
+        self.timings = timings
+        if polling is None:
+            polling = PollingPolicy()
+        self.polling = polling
+        self.last_run_stats = None
+        # cache key of the last run and, if it was a cache hit, its datafile
+        self._run_key = None
+        self._cached_datafile = None
+        self.session = session
+        self.pool_size = pool_size
+        self._owns_session = session is None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """ Close the session if it was created by this client. """
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def auth(self, sim_type, sim_id):
+        """ Connect to the server and returns the data for the simulation identified by sim_id. """
+        req = auth_request(sim_type, sim_id, self.secret)
+        self.cookies = None
+        res = await self._post_json('bluesky-auth', req)
+        assert 'state' in res and res['state'] == 'ok', 'bluesky_auth failed: {}'.format(res)
+        self.sim_type = sim_type
+        self.sim_id = sim_id
+        self.schema = res['schema']
+        self.data = res['data']
+        return self.data, self.schema
+
+    async def copy_sim(self, sim_name):
+        """ Create a copy of the current simulation. Returns a new instance of AsyncSirepoBluesky. """
+        assert self.sim_id
+        res = await self._post_json('copy-simulation', {
+            'simulationId': self.sim_id,
+            'simulationType': self.sim_type,
+            'folder': self.data['models']['simulation']['folder'],
+            'name': sim_name,
+        })
+        copy = AsyncSirepoBluesky(self.server, self.secret, session=self._get_session(),
+                                  polling=self.polling, cache=self.cache, timings=self.timings)
+        copy.cookies = self.cookies
+        copy.sim_type = self.sim_type
+        copy.sim_id = res['models']['simulation']['simulationId']
+        copy.schema = self.schema
+        copy.data = res
+        copy.is_copy = True
+        return copy
+
+    async def delete_copy(self):
+        """ Delete a simulation which was created using copy_sim(). """
+        assert self.is_copy
+        res = await self._post_json('delete-simulation', {
+            'simulationId': self.sim_id,
+            'simulationType': self.sim_type,
+        })
+        assert res['state'] == 'ok'
+        self.sim_id = None
+
+    async def get_datafile(self):
+        """ Requests the raw datafile of simulation results from the server.
+        Call auth() and run_simulation() before this. """
+        assert hasattr(self, 'cookies'), 'call auth() before get_datafile()'
+        if self._cached_datafile is not None:
+            return self._cached_datafile
+        url = self._datafile_url()
+        with self.timings.time('download-data-file'):
+            async with self._get_session().get('{}/{}'.format(self.server, url), cookies=self.cookies) as response:
+                self._assert_success(response, url)
+                content = await response.read()
+        self._store_datafile(content=content)
+        return content
+
+    async def download_datafile(self, filename, chunk_size=1024 * 1024, hash_name='md5', buffer=None):
+        """ Streams the raw datafile of simulation results to filename and returns its hex digest.
+
+        See SirepoBluesky.download_datafile().
+        """
+        assert hasattr(self, 'cookies'), 'call auth() before download_datafile()'
+        if self._cached_datafile is not None:
+            return self._write_cached_datafile(filename, hash_name, buffer)
+        h = hashlib.new(hash_name)
+        url = self._datafile_url()
+        with self.timings.time('download-data-file'):
+            async with self._get_session().get('{}/{}'.format(self.server, url), cookies=self.cookies) as response:
+                self._assert_success(response, url)
+                with open(filename, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        h.update(chunk)
+                        f.write(chunk)
+                        if buffer is not None:
+                            buffer.write(chunk)
+        self._store_datafile(filename=filename)
+        return h.hexdigest()
+
+    async def run_simulation(self, max_status_calls=1000, polling=None):
+        """ Run the sirepo simulation and returns the formatted plot data.
+
+        See SirepoBluesky.run_simulation().
+        """
+        tracker = self._start_run(polling)
+        if tracker is None:
+            return {'state': 'completed', 'cached': True}
+        res = await self._post_json('run-simulation', self.data)
+        tracker.received(res['state'], status_call=False)
+        for _ in range(max_status_calls):
+            state = res['state']
+            if state == 'completed' or state == 'error':
+                break
+            await asyncio.sleep(tracker.next_delay())
+            res = await self._post_json('run-status', res['nextRequest'])
+            tracker.received(res['state'])
+        self._finish_run(tracker, state)
+        return res
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = create_async_session(self.pool_size)
+        return self.session
+
+    @staticmethod
+    def _assert_success(response, url):
+        assert response.status == 200, '{} request failed, status: {}'.format(url, response.status)
+
+    async def _post_json(self, url, payload):
+        with self.timings.time(url):
+            async with self._get_session().post('{}/{}'.format(self.server, url), json=payload,
+                                                cookies=self.cookies) as response:
+                self._assert_success(response, url)
+                if not self.cookies:
+                    self.cookies = response.cookies
+                # sirepo does not always label its json responses as such
+                return await response.json(content_type=None)
@@ -0,0 +1,274 @@
+"""
+Throughput benchmarks of the detector, the flyer and the SRW file handler,
+run against the local stand-in Sirepo server.
+
+Run from the root of the repo:
+
+    $ PYTHONPATH=. python benchmarks/run_benchmarks.py --output results.json
+
+and compare the JSON files of two releases.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+import sirepo_detector
+from local_sirepo_server import BEAMLINE_SIM_ID, LocalSirepoServer, srw_file_content
+from srw_handler import SRWFileHandler, read_srw_file
+
+
+class MemoryRegistry(object):
+    """ Minimal stand-in of the databroker registry used by SirepoDetector. """
+
+    def __init__(self):
+        self.resources = {}
+        self.datums = {}
+
+    def insert_resource(self, spec, resource_path, resource_kwargs):
+        uid = str(len(self.resources))
+        self.resources[uid] = (spec, resource_path, resource_kwargs)
+        return uid
+
+    def insert_datum(self, resource, datum_id, datum_kwargs):
+        self.datums[datum_id] = (resource, datum_kwargs)
+        return datum_id
+
+
+def summary(samples):
+    """ Returns the statistics of a list of durations in seconds. """
+    samples = np.asarray(samples, dtype=float)
+    return {'n': int(samples.size),
+            'mean': float(np.mean(samples)),
+            'median': float(np.median(samples)),
+            'p90': float(np.percentile(samples, 90)),
+            'min': float(np.min(samples)),
+            'max': float(np.max(samples))}
+
+
+@contextlib.contextmanager
+def timed(durations, phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        durations.setdefault(phase, []).append(time.perf_counter() - start)
+
+
+def _wrap(obj, name, durations, phase):
+    """ Records the duration of each call of obj.name under phase. """
+    func = getattr(obj, name)
+
+    def wrapper(*args, **kwargs):
+        with timed(durations, phase):
+            return func(*args, **kwargs)
+
+    setattr(obj, name, wrapper)
+
+
+def make_detector(server, root_dir):
+    det = sirepo_detector.SirepoDetector(sim_id=BEAMLINE_SIM_ID, reg=MemoryRegistry(),
+                                         sirepo_server=server.url)
+    det.root_dir = root_dir
+    det.select_optic('Aperture')
+    param = det.create_parameter('horizontalSize')
+    det.read_attrs = ['image', 'mean', 'photon_energy']
+    det.configuration_attrs = ['horizontal_extent', 'vertical_extent', 'shape']
+    return det, param
+
+
+def bench_detector_trigger(server, root_dir, points):
+    """ Latency of SirepoDetector.trigger, in total and per phase. """
+    det, param = make_detector(server, root_dir)
+    durations = {}
+    _wrap(det.sb, 'run_simulation', durations, 'run_simulation')
+    _wrap(det.sb, 'get_datafile', durations, 'download')
+    _wrap(det.reg, 'insert_resource', durations, 'insert_resource')
+    _wrap(det.reg, 'insert_datum', durations, 'insert_datum')
+    read = sirepo_detector.read_srw_file
+
+    def timed_read(*args, **kwargs):
+        with timed(durations, 'read_srw_file'):
+            return read(*args, **kwargs)
+
+    sirepo_detector.read_srw_file = timed_read
+    try:
+        for i in range(points):
+            param.set(0.1 * (i + 1))
+            with timed(durations, 'total'):
+                det.trigger().wait()
+    finally:
+        sirepo_detector.read_srw_file = read
+        det.close()
+    return {phase: summary(samples) for phase, samples in durations.items()}
+
+
+def bench_flyer(server, root_dir, copy_counts, run_parallel_values):
+    """ Points per second of SirepoFlyer versus the number of copies and run_parallel. """
+    from bluesky import RunEngine
+    import bluesky.plans as bp
+    from sirepo_flyer import SirepoFlyer
+
+    RE = RunEngine({})
+    results = []
+    for run_parallel in run_parallel_values:
+        for copy_count in copy_counts:
+            params_to_change = [{'Aperture': {'horizontalSize': 0.1 * (i + 1)}} for i in range(copy_count)]
+            flyer = SirepoFlyer(sim_id=BEAMLINE_SIM_ID, server_name=server.url, root_dir=root_dir,
+                                params_to_change=params_to_change, watch_name='W60',
+                                run_parallel=run_parallel)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                RE(bp.fly([flyer]))
+            elapsed = time.perf_counter() - start
+            flyer.close()
+            results.append({'copy_count': copy_count,
+                            'run_parallel': run_parallel,
+                            'elapsed': elapsed,
+                            'points_per_second': copy_count / elapsed,
+                            'phases': dict(flyer.last_durations)})
+    return results
+
+
+def srwpy_read(filename):
+    """ Reference reader, through srwpy, which read_srw_file replaces. """
+    import srwpy.uti_plot_com as srw_io
+    data, mode, ranges, labels, units = srw_io.file_load(filename)
+    return np.array(data).reshape((ranges[8], ranges[5]), order='C')
+
+
+def _has_srwpy():
+    try:
+        import srwpy.uti_plot_com  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def bench_read(tmp_dir, sizes, repeat):
+    """ Decode throughput of read_srw_file, SRWFileHandler and the srwpy reader versus the image size.
+
+    srwpy is optional: without it, the srwpy entries are None and the output
+    of read_srw_file is only checked against the written values.
+    """
+    with_srwpy = _has_srwpy()
+    results = []
+    for n in sizes:
+        x = np.linspace(-1, 1, n)
+        values = np.exp(-np.add.outer(x ** 2, x ** 2))
+        filename = os.path.join(tmp_dir, 'bench_{}.dat'.format(n))
+        with open(filename, 'wb') as f:
+            f.write(srw_file_content((4240., 4240., 1, -1e-3, 1e-3, n, -1e-3, 1e-3, n), values))
+        file_size = os.path.getsize(filename)
+        data = read_srw_file(filename)['data']
+        np.testing.assert_allclose(data, values, rtol=1e-6)
+        if with_srwpy:
+            np.testing.assert_array_equal(data, srwpy_read(filename))
+        read_durations = []
+        handler_durations = []
+        srwpy_durations = []
+        for _ in range(repeat):
+            if with_srwpy:
+                start = time.perf_counter()
+                srwpy_read(filename)
+                srwpy_durations.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            read_srw_file(filename)
+            read_durations.append(time.perf_counter() - start)
+            # decode from the sidecar rather than the in-memory cache
+            SRWFileHandler.cache.clear()
+            start = time.perf_counter()
+            SRWFileHandler(filename)()
+            handler_durations.append(time.perf_counter() - start)
+        result = {'shape': [n, n],
+                  'file_bytes': file_size,
+                  'read_srw_file': summary(read_durations),
+                  'read_srw_file_mb_per_second': file_size / 1e6 / float(np.median(read_durations)),
+                  'handler': summary(handler_durations),
+                  'handler_mb_per_second': file_size / 1e6 / float(np.median(handler_durations)),
+                  'srwpy': None,
+                  'srwpy_mb_per_second': None,
+                  'speedup_vs_srwpy': None}
+        if with_srwpy:
+            result.update({'srwpy': summary(srwpy_durations),
+                           'srwpy_mb_per_second': file_size / 1e6 / float(np.median(srwpy_durations)),
+                           'speedup_vs_srwpy': float(np.median(srwpy_durations) / np.median(read_durations))})
+        results.append(result)
+    return results
+
+
+def bench_scan(server, root_dir, points, depth=None):
+    """ End-to-end rate of bp.scan over a SirepoDetector parameter, with depth points run ahead. """
+    from bluesky import RunEngine
+    import bluesky.plans as bp
+
+    det, param = make_detector(server, root_dir)
+    RE = RunEngine({})
+    start = time.perf_counter()
+    if depth is not None:
+        det.prefetch_plan(bp.scan([det], param, 0.1, 1, points), depth=depth)
+    RE(bp.scan([det], param, 0.1, 1, points))
+    elapsed = time.perf_counter() - start
+    det.close()
+    return {'points': points, 'depth': depth, 'elapsed': elapsed, 'points_per_second': points / elapsed}
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Sirepo detector, flyer and handler.')
+    parser.add_argument('--output', default=None, help='JSON file to write, defaults to stdout')
+    parser.add_argument('--run-time', type=float, default=0.5, help='simulated run time in seconds')
+    parser.add_argument('--shape', type=int, nargs=2, default=(100, 100), metavar=('NX', 'NY'),
+                        help='number of points of the served images')
+    parser.add_argument('--points', type=int, default=10, help='number of detector triggers and scan points')
+    parser.add_argument('--depth', type=int, default=4, help='number of scan points run ahead')
+    parser.add_argument('--copy-counts', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--read-sizes', type=int, nargs='+', default=[100, 300, 1000])
+    parser.add_argument('--repeat', type=int, default=3, help='number of reads per image size')
+    args = parser.parse_args()
+
+    server_config = {'run_time': args.run_time, 'image_shape': list(args.shape)}
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            LocalSirepoServer(run_time=args.run_time, image_shape=args.shape) as server:
+        Path(tmp_dir, datetime.datetime.now().strftime('%Y/%m/%d')).mkdir(parents=True)
+        results = {
+            'detector_trigger': bench_detector_trigger(server, tmp_dir, args.points),
+            'flyer': bench_flyer(server, tmp_dir, args.copy_counts, [False, True]),
+            'read': bench_read(tmp_dir, args.read_sizes, args.repeat),
+            'scan': bench_scan(server, tmp_dir, args.points),
+            'scan_prefetch': bench_scan(server, tmp_dir, args.points, depth=args.depth),
+        }
+
+    report = {'meta': {'date': datetime.datetime.now().isoformat(),
+                       'git_revision': _git_revision(),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'platform': platform.platform(),
+                       'server': server_config},
+              'results': results}
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
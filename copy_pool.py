@@ -0,0 +1,113 @@
+import atexit
+import copy
+import threading
+from collections import deque
+
+from sim_cache import IGNORED_SIMULATION_FIELDS
+
+
+class SimulationCopyPool(object):
+    """
+    Pool of copies of a source simulation, kept alive between fly scans.
+
+    acquire() returns an idle copy, or creates a new one with copy_sim(),
+    with the models of the source simulation as they were in sb when the
+    pool was created, including the local edits. release() puts the copy
+    back, or deletes it if max_idle copies are already idle. All the copies,
+    including the ones still checked out, are deleted by close(), which is
+    also called at interpreter exit.
+
+    Parameters
+    ----------
+    sb: SirepoBluesky
+        Client authenticated to the source simulation.
+    max_idle: int, optional
+        Maximum number of idle copies kept on the server. Defaults is 10.
+    copy_name: str, optional
+        Name given to the new copies. Defaults to '<source name> Bluesky'.
+
+    Examples
+    --------
+    sb = SirepoBluesky('http://localhost:8000')
+    sb.auth('srw', sim_id)
+    pool = SimulationCopyPool(sb, max_idle=50)
+    sirepo_flyer = SirepoFlyer(sim_id=sim_id, server_name='http://localhost:8000',
+                               root_dir=ROOT_DIR, params_to_change=params_to_change,
+                               copy_pool=pool)
+    RE(bp.fly([sirepo_flyer]))
+    RE(bp.fly([sirepo_flyer]))  # reuses the copies of the first scan
+    pool.close()
+
+    """
+
+    def __init__(self, sb, max_idle=10, copy_name=None):
+        self.sb = sb
+        self.max_idle = max_idle
+        if copy_name is None:
+            copy_name = '{} Bluesky'.format(sb.data['models']['simulation']['name'])
+        self.copy_name = copy_name
+        self._base_models = copy.deepcopy(sb.data['models'])
+        self._idle = deque()
+        self._checked_out = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return ('SimulationCopyPool(sim_id={!r}, idle={}, checked_out={}, max_idle={})'
+                .format(self.sb.sim_id, len(self._idle), len(self._checked_out), self.max_idle))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    @property
+    def checked_out_count(self):
+        return len(self._checked_out)
+
+    def acquire(self):
+        """ Returns a copy of the source simulation with the source models. """
+        with self._lock:
+            c = self._idle.popleft() if self._idle else None
+        if c is None:
+            # name doesn't need to be unique, server will rename it
+            c = self.sb.copy_sim(self.copy_name)
+        # the server has the stored models, not the local edits of sb
+        self._reset(c)
+        with self._lock:
+            self._checked_out[id(c)] = c
+        return c
+
+    def release(self, c):
+        """ Returns a copy obtained with acquire() to the pool. """
+        with self._lock:
+            self._checked_out.pop(id(c), None)
+            keep = len(self._idle) < self.max_idle
+            if keep:
+                self._idle.append(c)
+        if not keep:
+            c.delete_copy()
+
+    def close(self):
+        """ Deletes all the copies from the server. """
+        atexit.unregister(self.close)
+        with self._lock:
+            copies = list(self._idle) + list(self._checked_out.values())
+            self._idle.clear()
+            self._checked_out.clear()
+        for c in copies:
+            if c.sim_id is not None:
+                c.delete_copy()
+
+    def _reset(self, c):
+        simulation = copy.deepcopy(self._base_models['simulation'])
+        simulation.update({k: v for k, v in c.data['models']['simulation'].items()
+                           if k in IGNORED_SIMULATION_FIELDS})
+        c.data['models'] = copy.deepcopy(self._base_models)
+        c.data['models']['simulation'] = simulation
+        c.data.pop('report', None)
@@ -0,0 +1,55 @@
+import asyncio
+import hashlib
+import time
+
+from async_sirepo_bluesky import AsyncSirepoBluesky
+
+# use the "Youngs Double Slit Experiment" example simulation
+sim_id = '87XJ4oEb'
+COPY_COUNT = 100
+
+
+def prepare(c1, i):
+    # vary an aperture position
+    aperture = c1.find_element(c1.data['models']['beamline'], 'title', 'Aperture')
+    aperture['position'] = float(aperture['position']) + 0.5 * (i + 1)
+    watch = c1.find_element(c1.data['models']['beamline'], 'title', 'W60')
+    c1.data['report'] = 'watchpointReport{}'.format(watch['id'])
+
+
+async def run(sim):
+    print('running sim {}'.format(sim.sim_id))
+    await sim.run_simulation()
+
+
+async def main():
+    async with AsyncSirepoBluesky('http://10.10.10.10:8000') as sb:
+        await sb.auth('srw', sim_id)
+
+        start_time = time.time()
+        # name doesn't need to be unique, server will rename it
+        copies = await asyncio.gather(*[sb.copy_sim('{} Bluesky'.format(sb.data['models']['simulation']['name']))
+                                        for i in range(COPY_COUNT)])
+        for i, c1 in enumerate(copies):
+            print('copy {}, {}'.format(c1.sim_id, c1.data['models']['simulation']['name']))
+            prepare(c1, i)
+        cc_time = time.time()
+
+        await asyncio.gather(*[run(c1) for c1 in copies])
+        run_time = time.time()
+
+        # get results and clean up the copied simulations
+        files = await asyncio.gather(*[c1.get_datafile() for c1 in copies])
+        for c1, f in zip(copies, files):
+            print('copy {} data hash: {}'.format(c1.sim_id, hashlib.md5(f).hexdigest()))
+        await asyncio.gather(*[c1.delete_copy() for c1 in copies])
+        clean_time = time.time()
+
+    print('Copy creation time:', cc_time - start_time)
+    print('Simulation time:', run_time - cc_time)
+    print('Clean up time:', clean_time - run_time)
+    print('Total time:', clean_time - start_time)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,399 @@
+"""
+Lightweight stand-in for a Sirepo server, for offline tests and benchmarks.
+
+It implements the endpoints used by SirepoBluesky (bluesky-auth,
+copy-simulation, delete-simulation, run-simulation, run-status and
+download-data-file) and serves synthetic SRW intensity files: a Gaussian beam
+whose size and position follow the first aperture of the beamline, modulated
+by double slit fringes whose period follows the first obstacle.
+
+Run it from the command line:
+
+    $ python local_sirepo_server.py --port 8000 --run-time 1 --shape 1000 1000
+
+or from Python:
+
+    with LocalSirepoServer(run_time=0.5, image_shape=(200, 100)) as server:
+        sb = SirepoBluesky(server.url)
+        sb.auth('srw', BEAMLINE_SIM_ID)
+
+"""
+import argparse
+import base64
+import copy
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numconv
+import numpy as np
+
+# same ids as the example simulations used throughout this repo
+BEAMLINE_SIM_ID = '87XJ4oEb'
+SOURCE_SIM_ID = '8GJJWLFh'
+
+_COOKIE_NAME = 'sirepo_dev'
+
+
+def _beamline_simulation(sim_id):
+    return {
+        'models': {
+            'simulation': {'simulationId': sim_id, 'name': "Young's Double Slit Experiment",
+                           'folder': '/Wavefront Propagation', 'isExample': True, 'notes': '',
+                           'documentationUrl': '', 'simulationSerial': 1582648174281053,
+                           'photonEnergy': '4240', 'sourceType': 'u', 'samplingMethod': '1',
+                           'sampleFactor': 1, 'distanceFromSource': '30',
+                           'horizontalPosition': 0, 'horizontalRange': '0.8', 'horizontalPointCount': 100,
+                           'verticalPosition': 0, 'verticalRange': '1', 'verticalPointCount': 100},
+            'beamline': [
+                {'id': 3, 'title': 'Lens', 'type': 'lens', 'position': '30',
+                 'horizontalFocalLength': 15, 'verticalFocalLength': '15',
+                 'horizontalOffset': 0, 'verticalOffset': 0},
+                {'id': 4, 'title': 'Aperture', 'type': 'aperture', 'position': '30', 'shape': 'r',
+                 'horizontalSize': 1, 'verticalSize': 0.34, 'horizontalOffset': 0, 'verticalOffset': 0},
+                {'id': 5, 'title': 'Obstacle', 'type': 'obstacle', 'position': '30', 'shape': 'r',
+                 'horizontalSize': 10, 'verticalSize': 0.2, 'horizontalOffset': 0, 'verticalOffset': 0},
+                {'id': 6, 'title': 'W30', 'type': 'watch', 'position': '30'},
+                {'id': 7, 'title': 'W60', 'type': 'watch', 'position': '60'},
+            ],
+            'watchpointReport6': {'characteristic': 0, 'polarization': 6, 'precision': 0.01},
+            'watchpointReport7': {'characteristic': 0, 'polarization': 6, 'precision': 0.01},
+            'intensityReport': {'initialEnergy': '100', 'finalEnergy': '8000', 'photonEnergyPointCount': 10000,
+                                'horizontalPosition': '0', 'verticalPosition': 0, 'distanceFromSource': '30',
+                                'polarization': 6, 'precision': 0.01, 'method': '1', 'fieldUnits': '1'},
+            'electronBeam': {'name': 'APS', 'energy': 7, 'current': 0.1},
+            'undulator': {'period': '33', 'length': '2.3265', 'verticalAmplitude': '0.7'},
+        },
+        'report': 'intensityReport',
+        'simulationType': 'srw',
+        'version': '20200123.151222',
+    }
+
+
+def _source_simulation(sim_id):
+    data = _beamline_simulation(sim_id)
+    data['models']['simulation'].update(name='NSLS-II CHX beamline', folder='/Light Source Facilities/NSLS-II')
+    data['models']['beamline'] = []
+    return data
+
+
+def _float(value, default=0.):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def srw_file_content(ranges, values, label='Intensity', units='ph/s/.1%bw/mm^2'):
+    """ Returns the bytes of an SRW ASCII file with the given ranges (e0, e1, ne, x0, x1, nx, y0, y1, ny). """
+    e0, e1, ne, x0, x1, nx, y0, y1, ny = ranges
+    header = ['#{} [{}] (C-aligned, inner loop is vs Photon Energy, outer loop vs Vertical Position)'
+              .format(label, units)]
+    for (start, end, n), name, unit in zip(((e0, e1, ne), (x0, x1, nx), (y0, y1, ny)),
+                                           ('Photon Energy', 'Horizontal Position', 'Vertical Position'),
+                                           ('eV', 'm', 'm')):
+        header.append('#{!r} #Initial {} [{}]'.format(float(start), name, unit))
+        header.append('#{!r} #Final {} [{}]'.format(float(end), name, unit))
+        header.append('#{} #Number of points vs {}'.format(int(n), name))
+    buf = io.BytesIO()
+    buf.write(('\n'.join(header) + '\n').encode())
+    np.savetxt(buf, np.ravel(values), fmt='%.6e')
+    return buf.getvalue()
+
+
+def synthetic_datafile(data, image_shape=(100, 100)):
+    """ Returns the synthetic SRW file of data['report'] computed from data['models']. """
+    models = data['models']
+    if data['report'] == 'intensityReport':
+        report = models['intensityReport']
+        e0, e1 = _float(report['initialEnergy'], 100.), _float(report['finalEnergy'], 8000.)
+        ne = int(report['photonEnergyPointCount'])
+        energy = np.linspace(e0, e1, ne)
+        center = _float(models['simulation']['photonEnergy'], (e0 + e1) / 2)
+        values = 1e14 * np.exp(-0.5 * ((energy - center) / (0.01 * center + 1)) ** 2)
+        return srw_file_content((e0, e1, ne, 0., 0., 1, 0., 0., 1), values)
+
+    beamline = models['beamline']
+    aperture = next((e for e in beamline if e['type'] == 'aperture'), {})
+    obstacle = next((e for e in beamline if e['type'] == 'obstacle'), {})
+    lens = next((e for e in beamline if e['type'] == 'lens'), {})
+    nx, ny = image_shape
+    # ranges, sizes and offsets are in mm
+    half_x = _float(models['simulation']['horizontalRange'], 1.) * 1e-3 / 2
+    half_y = _float(models['simulation']['verticalRange'], 1.) * 1e-3 / 2
+    x = np.linspace(-half_x, half_x, nx)
+    y = np.linspace(-half_y, half_y, ny)
+    sigma_x = max(_float(aperture.get('horizontalSize'), 1.), 1e-3) * 1e-3 / 4
+    sigma_y = max(_float(aperture.get('verticalSize'), 1.), 1e-3) * 1e-3 / 4
+    sigma_x *= 1 + 1 / max(_float(lens.get('horizontalFocalLength'), 15.), 1e-3)
+    x0 = _float(aperture.get('horizontalOffset')) * 1e-3
+    y0 = _float(aperture.get('verticalOffset')) * 1e-3
+    period = max(_float(obstacle.get('verticalSize'), 0.2), 1e-3) * 1e-3
+    gx = np.exp(-0.5 * ((x - x0) / sigma_x) ** 2)
+    gy = np.exp(-0.5 * ((y - y0) / sigma_y) ** 2) * (1 + np.cos(2 * np.pi * (y - y0) / period)) / 2
+    values = 1e13 * np.outer(gy, gx)
+    energy = _float(models['simulation']['photonEnergy'], 4240.)
+    return srw_file_content((energy, energy, 1, x[0], x[-1], nx, y[0], y[-1], ny), values)
+
+
+class _Run(object):
+    def __init__(self, data, duration, failed):
+        self.data = data
+        self.started = time.monotonic()
+        self.duration = duration
+        self.failed = failed
+
+    def state(self):
+        if time.monotonic() - self.started < self.duration:
+            return 'running'
+        return 'error' if self.failed else 'completed'
+
+
+class LocalSirepoServer(object):
+    """
+    In-process stand-in for a Sirepo server.
+
+    Parameters
+    ----------
+    host: str, optional
+        Address to listen to. Defaults to '127.0.0.1'.
+    port: int, optional
+        Port to listen to. Defaults to 0 (any free port).
+    secret: str, optional
+        Secret key shared with the clients. Defaults to 'bluesky'.
+    run_time: float, optional
+        Simulated duration of a run in seconds. Defaults is 0.
+    failure_rate: float, optional
+        Probability for a run to end in the 'error' state. Defaults is 0.
+    image_shape: tuple, optional
+        Number of horizontal and vertical points of the watchpoint images.
+        Defaults is (100, 100).
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, secret='bluesky', run_time=0., failure_rate=0.,
+                 image_shape=(100, 100)):
+        self.secret = secret
+        self.run_time = run_time
+        self.failure_rate = failure_rate
+        self.image_shape = tuple(image_shape)
+        self.requests = Counter()
+        self.simulations = {BEAMLINE_SIM_ID: _beamline_simulation(BEAMLINE_SIM_ID),
+                            SOURCE_SIM_ID: _source_simulation(SOURCE_SIM_ID)}
+        self._runs = {}
+        self._tokens = set()
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    def __repr__(self):
+        return 'LocalSirepoServer({!r})'.format(self.url)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        """ Serve the requests from a background thread. """
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def _check_auth(self, req):
+        h = hashlib.sha256()
+        h.update(':'.join([req.get('authNonce', ''), req['simulationType'], req['simulationId'],
+                           self.secret]).encode())
+        return req.get('authHash') == 'v1:' + base64.urlsafe_b64encode(h.digest()).decode()
+
+    def _new_sim_id(self):
+        r = random.SystemRandom()
+        return ''.join(r.choice(numconv.BASE62) for _ in range(8))
+
+    def _datafile(self, data):
+        key = hashlib.sha256(json.dumps([data['models'], data['report']], sort_keys=True).encode()).hexdigest()
+        with self._lock:
+            if key in self._files:
+                self._files.move_to_end(key)
+                return self._files[key]
+        content = synthetic_datafile(data, self.image_shape)
+        with self._lock:
+            self._files[key] = content
+            while len(self._files) > 16:
+                self._files.popitem(last=False)
+        return content
+
+    # endpoints, return (status, json payload or bytes)
+
+    def bluesky_auth(self, req):
+        sim = self.simulations.get(req.get('simulationId'))
+        if sim is None or not self._check_auth(req):
+            return 403, {'state': 'error', 'error': 'bluesky auth failed'}
+        return 200, {'state': 'ok', 'data': copy.deepcopy(sim), 'schema': {'simulationType': 'srw'}}
+
+    def copy_simulation(self, req):
+        sim_id = self._new_sim_id()
+        # the unique name is picked and stored at once, the copies are made concurrently
+        with self._lock:
+            sim = self.simulations.get(req['simulationId'])
+            if sim is None:
+                return 404, {'state': 'error', 'error': 'simulation not found'}
+            new = copy.deepcopy(sim)
+            names = {s['models']['simulation']['name'] for s in self.simulations.values()}
+            name = req['name']
+            n = 2
+            while name in names:
+                name = '{} {}'.format(req['name'], n)
+                n += 1
+            new['models']['simulation'].update(simulationId=sim_id, name=name, folder=req['folder'],
+                                               isExample=False)
+            self.simulations[sim_id] = new
+        return 200, copy.deepcopy(new)
+
+    def delete_simulation(self, req):
+        with self._lock:
+            sim = self.simulations.pop(req['simulationId'], None)
+        if sim is None:
+            return 404, {'state': 'error', 'error': 'simulation not found'}
+        return 200, {'state': 'ok'}
+
+    def run_simulation(self, req):
+        if req.get('simulationId') not in self.simulations:
+            return 404, {'state': 'error', 'error': 'simulation not found'}
+        data = {'models': copy.deepcopy(req['models']), 'report': req['report']}
+        run = _Run(data, self.run_time, random.random() < self.failure_rate)
+        with self._lock:
+            self._runs[(req['simulationId'], req['report'])] = run
+        return 200, self._status(req['simulationId'], req['report'], run)
+
+    def run_status(self, req):
+        run = self._runs.get((req['simulationId'], req['report']))
+        if run is None:
+            return 200, {'state': 'missing'}
+        return 200, self._status(req['simulationId'], req['report'], run)
+
+    def download_data_file(self, sim_type, sim_id, report):
+        run = self._runs.get((sim_id, report))
+        if run is None or run.state() != 'completed':
+            return 404, {'state': 'error', 'error': 'no results for {} {}'.format(sim_id, report)}
+        return 200, self._datafile(run.data)
+
+    @staticmethod
+    def _status(sim_id, report, run):
+        state = run.state()
+        res = {'state': state}
+        if state == 'running':
+            res.update(nextRequestSeconds=2,
+                       nextRequest={'report': report, 'simulationId': sim_id, 'simulationType': 'srw'})
+        elif state == 'error':
+            res['error'] = 'simulated failure'
+        return res
+
+
+def _make_handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, payload, cookie=None):
+            if isinstance(payload, bytes):
+                body, content_type = payload, 'application/octet-stream'
+            else:
+                body, content_type = json.dumps(payload).encode(), 'application/json'
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if cookie:
+                self.send_header('Set-Cookie', '{}={}; HttpOnly; Path=/'.format(_COOKIE_NAME, cookie))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _authorized(self):
+            cookies = self.headers.get('Cookie', '')
+            with server._lock:
+                tokens = set(server._tokens)
+            return any(c.strip() == '{}={}'.format(_COOKIE_NAME, t)
+                       for c in cookies.split(';') for t in tokens)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            endpoint = self.path.strip('/')
+            with server._lock:
+                server.requests[endpoint] += 1
+            req = json.loads(body) if body else {}
+            if endpoint == 'bluesky-auth':
+                status, payload = server.bluesky_auth(req)
+                token = None
+                if status == 200:
+                    token = ''.join(random.choice(numconv.BASE62) for _ in range(32))
+                    with server._lock:
+                        server._tokens.add(token)
+                return self._reply(status, payload, cookie=token)
+            if not self._authorized():
+                return self._reply(403, {'state': 'error', 'error': 'not authenticated'})
+            method = {'copy-simulation': server.copy_simulation,
+                      'delete-simulation': server.delete_simulation,
+                      'run-simulation': server.run_simulation,
+                      'run-status': server.run_status}.get(endpoint)
+            if method is None:
+                return self._reply(404, {'state': 'error', 'error': 'unknown route'})
+            self._reply(*method(req))
+
+        def do_GET(self):
+            with server._lock:
+                server.requests['download-data-file'] += 1
+            m = re.match(r'^/download-data-file/([^/]+)/([^/]+)/([^/]+)/-?\d+$', self.path)
+            if m is None:
+                return self._reply(404, {'state': 'error', 'error': 'unknown route'})
+            if not self._authorized():
+                return self._reply(403, {'state': 'error', 'error': 'not authenticated'})
+            self._reply(*server.download_data_file(*m.groups()))
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in Sirepo server serving synthetic SRW files.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--secret', default='bluesky')
+    parser.add_argument('--run-time', type=float, default=0., help='simulated run time in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0., help='probability of a failed run')
+    parser.add_argument('--shape', type=int, nargs=2, default=(100, 100), metavar=('NX', 'NY'),
+                        help='number of points of the watchpoint images')
+    args = parser.parse_args()
+    server = LocalSirepoServer(args.host, args.port, args.secret, run_time=args.run_time,
+                               failure_rate=args.failure_rate, image_shape=args.shape)
+    print('Serving at {}, simulations: beamline {}, source {}'.format(server.url, BEAMLINE_SIM_ID, SOURCE_SIM_ID))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import numbers
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from copy_pool import SimulationCopyPool
+
+
+def positions_from_plan(plan, detector, parameters):
+    """
+    Returns the values of parameters at each trigger of detector in plan.
+
+    The plan is consumed without a RunEngine, it must not depend on the
+    readings, as step scans don't.
+
+    Parameters
+    ----------
+    plan: generator
+        Plan, e.g. bp.scan([det], param, 0, 1, 10)
+    detector: Device
+        Detector triggered by the plan
+    parameters: list
+        Axes set by the plan, e.g. returned by SirepoDetector.create_parameter()
+
+    """
+    current = {param: param.readback.get() for param in parameters}
+    positions = []
+    for msg in plan:
+        if msg.command == 'set' and msg.obj in current:
+            current[msg.obj] = msg.args[0]
+        elif msg.command == 'trigger' and msg.obj is detector:
+            positions.append(tuple(current[param] for param in parameters))
+    return positions
+
+
+def _same_values(a, b):
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if isinstance(x, numbers.Number) and isinstance(y, numbers.Number):
+            if not np.isclose(x, y, rtol=1e-9, atol=0.):
+                return False
+        elif x != y:
+            return False
+    return True
+
+
+class Lookahead(object):
+    """
+    Runs the upcoming configurations of a simulation ahead of a step scan.
+
+    Up to depth configurations run at once, each on a copy of the simulation
+    from a SimulationCopyPool. take() hands out the datafiles in scan order
+    and submits the next configurations.
+
+    Parameters
+    ----------
+    sb: SirepoBluesky
+        Client authenticated to the source simulation.
+    fields: list
+        (optic title, field) of each value of the positions.
+    positions: sequence
+        Values of the fields for each upcoming point.
+    report: str
+        Report run for each point, e.g. 'watchpointReport7'.
+    depth: int, optional
+        Maximum number of configurations running at once. Defaults is 4.
+
+    """
+
+    def __init__(self, sb, fields, positions, report, depth=4):
+        if depth < 1:
+            raise ValueError(f'invalid depth: {depth}. Must be at least 1')
+        self.sb = sb
+        self.fields = list(fields)
+        self.report = report
+        self.depth = depth
+        self.hits = 0
+        self.misses = 0
+        self._optic_ids = {}
+        for i, element in enumerate(sb.data['models']['beamline']):
+            self._optic_ids.setdefault(element['title'], i)
+        self._positions = deque(tuple(p) for p in positions)
+        self._futures = deque()
+        self._pool = SimulationCopyPool(sb, max_idle=depth)
+        self._executor = ThreadPoolExecutor(max_workers=depth)
+        self._fill()
+
+    def __repr__(self):
+        return ('Lookahead(report={!r}, depth={}, running={}, upcoming={}, hits={}, misses={})'
+                .format(self.report, self.depth, len(self._futures), len(self._positions),
+                        self.hits, self.misses))
+
+    def _submit_next(self):
+        if self._positions:
+            values = self._positions.popleft()
+            self._futures.append((values, self._executor.submit(self._run, values)))
+
+    def _run(self, values):
+        c = self._pool.acquire()
+        try:
+            beamline = c.data['models']['beamline']
+            for (title, field), x in zip(self.fields, values):
+                beamline[self._optic_ids[title]][field] = x
+            c.data['report'] = self.report
+            c.run_simulation()
+            return c.get_datafile()
+        finally:
+            self._pool.release(c)
+
+    def take(self, values, report):
+        """ Returns the future of the datafile of values if they are one of the
+        upcoming points, or None.
+
+        The points queued before the matching one are dropped, so the
+        lookahead follows a scan which skipped points or triggered off-plan.
+        If values are only found further in the positions, the scan is past
+        all the queued points: they are dropped and the points after values
+        are queued.
+        """
+        if report == self.report:
+            for i, (upcoming, _) in enumerate(self._futures):
+                if _same_values(upcoming, values):
+                    self._drop(i)
+                    _, future = self._futures.popleft()
+                    self._fill()
+                    self.hits += 1
+                    return future
+            for i, upcoming in enumerate(self._positions):
+                if _same_values(upcoming, values):
+                    self._drop(len(self._futures))
+                    for _ in range(i + 1):
+                        self._positions.popleft()
+                    self._fill()
+                    break
+        self.misses += 1
+        return None
+
+    def _drop(self, count):
+        # the points not started yet are cancelled, the running ones release their copy when done
+        for _ in range(count):
+            _, future = self._futures.popleft()
+            future.cancel()
+
+    def _fill(self):
+        while len(self._futures) < self.depth and self._positions:
+            self._submit_next()
+
+    def close(self):
+        """ Cancels the points not started yet and deletes the copies. """
+        self._positions.clear()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._futures.clear()
+        self._pool.close()
@@ -15,7 +15,7 @@ from databroker import Broker, temp_config
 
 from ophyd.utils import make_dir_tree
 
-from srw_handler import SRWFileHandler
+from srw_handler import SRWContainerHandler, SRWFileHandler
 import matplotlib.pyplot as plt
 
 
@@ -34,6 +34,16 @@ except:
 RE.subscribe(db.insert)
 db.reg.register_handler('srw', SRWFileHandler, overwrite=True)
 db.reg.register_handler('SIREPO_FLYER', SRWFileHandler, overwrite=True)
+db.reg.register_handler('SIREPO_FLYER_HDF5', SRWContainerHandler, overwrite=True)
+# memory-map the binary sidecars written next to the SRW files when they are first read
+SRWFileHandler.use_sidecar = True
+# the in-memory cache of decoded images only applies with use_sidecar = False, the memory-mapped
+# sidecars are never stored in it (the page cache of the OS keeps them), so it is turned off here;
+# set e.g. 512 * 1024 ** 2 to keep up to 512 MiB of images, shared by all the handlers
+SRWFileHandler.cache.resize(0)
+# set to True to get dask arrays, read chunk by chunk, e.g. to reduce long runs with bounded memory
+SRWFileHandler.lazy = False
+SRWContainerHandler.lazy = False
 
 plt.ion()
 install_kicker()
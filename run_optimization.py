@@ -4,6 +4,7 @@ from random import random, uniform
 from multiprocessing import Process
 import hashlib
 
+from sim_cache import SimulationCache
 from sirepo_bluesky import SirepoBluesky
 import sirepo_detector as sd
 
@@ -352,7 +353,8 @@ sim_id = '3eP3NeVp'
 sb = SirepoBluesky('http://10.10.10.10:8000')
 sb.auth('srw', sim_id)
 
-sirepo_det = sd.SirepoDetector(sim_id=sim_id, reg=db.reg)
+# identical individuals are read from the cache instead of being simulated again
+sirepo_det = sd.SirepoDetector(sim_id=sim_id, reg=db.reg, cache=SimulationCache('/tmp/sirepo_cache'))
 
 field_list = []
 sirepo_det.select_optic('Toroid')
@@ -0,0 +1,284 @@
+import contextlib
+import threading
+import time
+
+from sirepo_bluesky import SirepoBluesky
+from timing import PhaseTimings
+
+
+def create_client(server, **kwargs):
+    """ Returns a SirepoBluesky for a server, or a ShardedSirepoBluesky for a list of servers. """
+    if isinstance(server, (list, tuple)):
+        return ShardedSirepoBluesky(server, **kwargs)
+    return SirepoBluesky(server, **kwargs)
+
+
+class _Shard(object):
+    """ A server of a ShardedSirepoBluesky, with its own client and statistics. """
+
+    def __init__(self, sb):
+        self.sb = sb
+        self.in_flight = 0
+        self.copies = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.drained_at = None
+        # a thread is checking the drained server again
+        self.probing = False
+
+    @property
+    def draining(self):
+        return self.drained_at is not None
+
+    @property
+    def load(self):
+        # each live copy will run on this server
+        return self.in_flight + self.copies
+
+
+class ShardedSirepoBluesky(object):
+    """
+    Spreads the copies and runs of a simulation across several Sirepo servers.
+
+    The simulation must exist with the same id on all the servers. Each
+    server has its own SirepoBluesky, with its auth cookies and session.
+    New copies and runs of the simulation go to the server with the least
+    outstanding work: requests in flight plus live copies. A copy then runs
+    on the server it was created on.
+
+    A server is drained after max_errors consecutive failed requests: it
+    gets no new copies or runs, its live copies are still used. It is checked
+    again after retry_interval seconds, and gets work again if it answers.
+
+    Parameters
+    ----------
+    servers: list of str
+        Sirepo servers to call, ex. ['http://host1:8000', 'http://host2:8000']
+    secret: str, optional
+        Secret key shared with the servers. Defaults to 'bluesky'.
+    max_errors: int, optional
+        Number of consecutive errors after which a server is drained. Defaults is 3.
+    retry_interval: float, optional
+        Seconds before a drained server is checked again. Defaults is 30.
+    timings: PhaseTimings, optional
+        Histograms of the durations of the requests and runs, shared by the
+        clients of all the servers. Created if not provided.
+    **kwargs
+        pool_size, polling and cache passed to each SirepoBluesky.
+
+    Examples
+    --------
+    sb = ShardedSirepoBluesky(['http://host1:8000', 'http://host2:8000'])
+    data, schema = sb.auth('srw', sim_id)
+    copies = [sb.copy_sim('Bluesky') for _ in range(10)]
+    ...
+    sb.stats()
+
+    or pass the list of servers to SirepoDetector(sirepo_server=...) or
+    SirepoFlyer(server_name=...).
+
+    """
+
+    find_element = staticmethod(SirepoBluesky.find_element)
+    find_optic_id_by_name = SirepoBluesky.find_optic_id_by_name
+
+    def __init__(self, servers, secret='bluesky', max_errors=3, retry_interval=30., timings=None, **kwargs):
+        assert servers, 'at least one server is needed'
+        self.servers = list(servers)
+        self.secret = secret
+        self.max_errors = max_errors
+        self.retry_interval = retry_interval
+        self.last_run_stats = None
+        if timings is None:
+            timings = PhaseTimings(','.join(self.servers))
+        self.timings = timings
+        self._shards = [_Shard(SirepoBluesky(server, secret, timings=timings, **kwargs))
+                        for server in self.servers]
+        self._lock = threading.Lock()
+        self._last_shard = None
+
+    def __repr__(self):
+        return 'ShardedSirepoBluesky({!r})'.format(self.servers)
+
+    def auth(self, sim_type, sim_id):
+        """ Connect to all the servers and returns the data for the simulation identified by sim_id.
+
+        The servers which fail are drained. The clients of all the servers
+        share the returned data.
+        """
+        self.sim_type = sim_type
+        self.sim_id = sim_id
+        self.data = None
+        for shard in self._shards:
+            try:
+                with self._track(shard):
+                    data, schema = shard.sb.auth(sim_type, sim_id)
+            except Exception:
+                self._drain(shard)
+                continue
+            if self.data is None:
+                self.data, self.schema = data, schema
+            shard.sb.data = self.data
+        assert self.data is not None, 'bluesky_auth failed on all the servers: {}'.format(self.servers)
+        return self.data, self.schema
+
+    def copy_sim(self, sim_name):
+        """ Create a copy of the current simulation on the least busy server. """
+        shard = self._pick(copy=True)
+        try:
+            with self._track(shard):
+                c = shard.sb.copy_sim(sim_name)
+        except Exception:
+            with self._lock:
+                shard.copies -= 1
+            raise
+        return _ShardCopy(self, shard, c)
+
+    def run_simulation(self, *args, **kwargs):
+        """ Run the simulation on the least busy server, see SirepoBluesky.run_simulation(). """
+        shard = self._pick()
+        self._last_shard = shard
+        with self._track(shard):
+            res = shard.sb.run_simulation(*args, **kwargs)
+        self.last_run_stats = shard.sb.last_run_stats
+        return res
+
+    def get_datafile(self):
+        """ Requests the datafile of the last run from the server which ran it. """
+        assert self._last_shard is not None, 'call run_simulation() before get_datafile()'
+        with self._track(self._last_shard):
+            return self._last_shard.sb.get_datafile()
+
+    def download_datafile(self, filename, **kwargs):
+        """ Streams the datafile of the last run from the server which ran it, see SirepoBluesky. """
+        assert self._last_shard is not None, 'call run_simulation() before download_datafile()'
+        with self._track(self._last_shard):
+            return self._last_shard.sb.download_datafile(filename, **kwargs)
+
+    def check_health(self):
+        """ Checks every server by authenticating to the simulation again.
+        Drains the servers which fail and brings back the ones which answer. """
+        for shard in self._shards:
+            self._probe(shard)
+        return {shard.sb.server: not shard.draining for shard in self._shards}
+
+    def stats(self):
+        """ Returns the load, requests, errors and state of each server. """
+        with self._lock:
+            return {shard.sb.server: {'in_flight': shard.in_flight,
+                                      'copies': shard.copies,
+                                      'requests': shard.requests,
+                                      'errors': shard.errors,
+                                      'draining': shard.draining}
+                    for shard in self._shards}
+
+    def connection_stats(self):
+        """ Returns SirepoBluesky.connection_stats() of each server. """
+        return {shard.sb.server: shard.sb.connection_stats() for shard in self._shards}
+
+    def _probe(self, shard):
+        probe = SirepoBluesky(shard.sb.server, self.secret, session=shard.sb.session)
+        try:
+            probe.auth(self.sim_type, self.sim_id)
+        except Exception:
+            self._drain(shard)
+            return False
+        # the server may have been down at auth()
+        shard.sb.cookies = probe.cookies
+        shard.sb.sim_type = self.sim_type
+        shard.sb.sim_id = self.sim_id
+        shard.sb.schema = probe.schema
+        shard.sb.data = self.data
+        with self._lock:
+            shard.drained_at = None
+            shard.consecutive_errors = 0
+        return True
+
+    def _pick(self, copy=False):
+        now = time.monotonic()
+        with self._lock:
+            # a single thread checks each drained server, the others pick among the live ones
+            due = [shard for shard in self._shards if shard.draining and not shard.probing
+                   and now - shard.drained_at >= self.retry_interval]
+            for shard in due:
+                shard.probing = True
+        for shard in due:
+            try:
+                self._probe(shard)
+            finally:
+                with self._lock:
+                    shard.probing = False
+        with self._lock:
+            shards = [shard for shard in self._shards if not shard.draining]
+            if not shards:
+                raise RuntimeError('all the servers are drained: {}'.format(self.servers))
+            shard = min(shards, key=lambda shard: shard.load)
+            if copy:
+                # counted now, so concurrent copy_sim() calls spread
+                shard.copies += 1
+            return shard
+
+    def _drain(self, shard):
+        with self._lock:
+            shard.drained_at = time.monotonic()
+
+    @contextlib.contextmanager
+    def _track(self, shard):
+        with self._lock:
+            shard.in_flight += 1
+            shard.requests += 1
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                shard.errors += 1
+                shard.consecutive_errors += 1
+                if shard.consecutive_errors >= self.max_errors:
+                    shard.drained_at = time.monotonic()
+            raise
+        else:
+            with self._lock:
+                shard.consecutive_errors = 0
+        finally:
+            with self._lock:
+                shard.in_flight -= 1
+
+
+class _ShardCopy(object):
+    """ Copy of the simulation on one of the servers of a ShardedSirepoBluesky,
+    which behaves as the SirepoBluesky of the copy and reports to its parent. """
+
+    def __init__(self, parent, shard, sb):
+        object.__setattr__(self, '_parent', parent)
+        object.__setattr__(self, '_shard', shard)
+        object.__setattr__(self, '_sb', sb)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._sb, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._sb, name, value)
+
+    def __repr__(self):
+        return '<copy {} on {}>'.format(self._sb.sim_id, self._sb.server)
+
+    def run_simulation(self, *args, **kwargs):
+        with self._parent._track(self._shard):
+            return self._sb.run_simulation(*args, **kwargs)
+
+    def get_datafile(self):
+        with self._parent._track(self._shard):
+            return self._sb.get_datafile()
+
+    def download_datafile(self, filename, **kwargs):
+        with self._parent._track(self._shard):
+            return self._sb.download_datafile(filename, **kwargs)
+
+    def delete_copy(self):
+        with self._parent._track(self._shard):
+            self._sb.delete_copy()
+        with self._parent._lock:
+            self._shard.copies -= 1
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+# fields of data['models']['simulation'] which identify a simulation but don't affect its results
+IGNORED_SIMULATION_FIELDS = ('simulationId', 'simulationSerial', 'name', 'folder', 'isExample',
+                             'lastModified', 'documentationUrl', 'notes', 'outOfSessionSimulationId')
+
+
+def cache_key(sim_type, data):
+    """ Returns the canonical hash of the simulation inputs which determine the datafile of data['report']. """
+    models = dict(data['models'])
+    models['simulation'] = {k: v for k, v in models.get('simulation', {}).items()
+                            if k not in IGNORED_SIMULATION_FIELDS}
+    payload = json.dumps({'simType': sim_type, 'models': models, 'report': data['report']},
+                         sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SimulationCache(object):
+    """
+    On-disk cache of simulation datafiles, keyed by the hash of the simulation inputs.
+
+    The least recently used files are evicted once the cache holds more than
+    max_bytes. The directory can be shared between processes, the
+    modification time of the files is used to track their last use.
+
+    Parameters
+    ----------
+    directory: str or Path
+        Directory where the datafiles are stored, created if needed.
+    max_bytes: int, optional
+        Maximum total size of the stored files. Defaults is 1 GiB.
+
+    Examples
+    --------
+    cache = SimulationCache('/tmp/sirepo_cache')
+    sb = SirepoBluesky('http://localhost:8000', cache=cache)
+    ...
+    cache.stats()
+
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'SimulationCache({!r}, max_bytes={})'.format(str(self.directory), self.max_bytes)
+
+    def __getstate__(self):
+        # the lock can't be pickled, e.g. to pass a client to a spawned process
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    key = staticmethod(cache_key)
+
+    def path(self, key):
+        """ Returns the path of the file stored for key, or None. Doesn't count as a lookup. """
+        path = self.directory / '{}.dat'.format(key)
+        return path if path.exists() else None
+
+    def get(self, key):
+        """ Returns the path of the file stored for key, or None, and updates the statistics. """
+        path = self.path(key)
+        with self._lock:
+            if path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if path is not None:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+        return path
+
+    def read(self, key):
+        """ Returns the bytes stored for key, or None, and updates the statistics.
+        Unlike get(), the result can't be evicted before the caller uses it. """
+        path = self.path(key)
+        content = None
+        if path is not None:
+            try:
+                os.utime(path)
+                content = path.read_bytes()
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return content
+
+    def put(self, key, content=None, filename=None):
+        """ Stores either the bytes in content or a copy of filename for key. Returns the stored path. """
+        assert (content is None) != (filename is None), 'provide either content or filename'
+        fd, tmp = tempfile.mkstemp(dir=str(self.directory), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            if content is not None:
+                f.write(content)
+            else:
+                with open(filename, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+        path = self.directory / '{}.dat'.format(key)
+        os.replace(tmp, path)
+        self._evict()
+        return path
+
+    def clear(self):
+        """ Removes all the stored files. """
+        for path in self.directory.glob('*.dat'):
+            path.unlink()
+
+    def stats(self):
+        """ Returns the number of hits, misses, evictions, stored files and stored bytes. """
+        entries = self._entries()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries)}
+
+    def _entries(self):
+        entries = []
+        for path in self.directory.glob('*.dat'):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        # keep at least the most recent file, even if it is larger than max_bytes
+        for _, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
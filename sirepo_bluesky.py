@@ -1,9 +1,177 @@
+import os
+import threading
+
 import requests
 import time
 import random
 import numconv
 import hashlib
 import base64
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from timing import PhaseTimings
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter which keeps track of how many connections its pools open and
+    how many requests are sent through it, so connection reuse can be checked.
+
+    The pools are reinitialized (without closing the sockets) when the
+    adapter is used from a forked process, so a child never writes to a
+    keep-alive connection which is still owned by its parent.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._init_counters()
+        super().__init__(*args, **kwargs)
+
+    def __setstate__(self, state):
+        self._init_counters()
+        super().__setstate__(state)
+
+    def _init_counters(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+    def _count_connection(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            def _new_conn(self):
+                adapter._count_connection()
+                return super()._new_conn()
+
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            def _new_conn(self):
+                adapter._count_connection()
+                return super()._new_conn()
+
+        self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool,
+                                                   'https': CountingHTTPSConnectionPool}
+
+    def send(self, request, **kwargs):
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self.init_poolmanager(self._pool_connections, self._pool_maxsize, block=self._pool_block)
+        with self._lock:
+            self.requests_sent += 1
+        return super().send(request, **kwargs)
+
+
+def create_session(pool_size=10):
+    """ Create a keep-alive requests.Session holding up to pool_size connections per host. """
+    session = requests.Session()
+    adapter = CountingHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class PollingPolicy(object):
+    """
+    Controls when run_simulation() checks the status of a running simulation.
+
+    The first status call is made `initial` seconds after the run was started,
+    then the interval grows by `factor` up to `max_interval`. Every interval is
+    randomized by +/- `jitter` (a fraction of the interval), so parallel copies
+    don't poll in lockstep.
+
+    Parameters
+    ----------
+    initial: float, optional
+        First interval in seconds. Defaults is 0.1.
+    factor: float, optional
+        Growth of the interval after each status call. Defaults is 1.5.
+    max_interval: float, optional
+        Upper bound of the interval in seconds. Defaults is 5.
+    timeout: float, optional
+        Wall-clock time in seconds after which the run is given up with a
+        TimeoutError. Defaults is None (no timeout).
+    jitter: float, optional
+        Relative randomization of each interval. Defaults is 0.1.
+
+    """
+
+    def __init__(self, initial=0.1, factor=1.5, max_interval=5., timeout=None, jitter=0.1):
+        self.initial = initial
+        self.factor = factor
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.jitter = jitter
+
+    def __repr__(self):
+        return ('PollingPolicy(initial={}, factor={}, max_interval={}, timeout={}, jitter={})'
+                .format(self.initial, self.factor, self.max_interval, self.timeout, self.jitter))
+
+    def interval(self, status_calls):
+        """ Returns the time to wait before the status call following status_calls calls. """
+        interval = min(self.initial * self.factor ** status_calls, self.max_interval)
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def start(self):
+        """ Returns the tracker of a run started now. """
+        return _PollTracker(self)
+
+
+class _PollTracker(object):
+    """ Book-keeping of the status calls of a single run. """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.status_calls = 0
+        self.started = time.monotonic()
+        self._pending = self.started
+        self._done = None
+
+    def next_delay(self):
+        """ Returns the time to wait before the next status call, or raises TimeoutError. """
+        delay = self.policy.interval(self.status_calls)
+        if self.policy.timeout is not None:
+            remaining = self.started + self.policy.timeout - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('simulation did not complete in {} s'.format(self.policy.timeout))
+            delay = min(delay, remaining)
+        return delay
+
+    def received(self, state, status_call=True):
+        """ Records a response from the server with the given simulation state. """
+        now = time.monotonic()
+        if status_call:
+            self.status_calls += 1
+        if state == 'completed' or state == 'error':
+            self._done = now
+        else:
+            self._pending = now
+
+    def stats(self):
+        """ Returns the number of status calls, the elapsed time and an upper bound of the time
+        between the end of the run and its detection. """
+        done = self._done if self._done is not None else time.monotonic()
+        return {'status_calls': self.status_calls,
+                'elapsed': done - self.started,
+                'detection_latency': done - self._pending if self.status_calls else 0.}
+
+
+def auth_request(sim_type, sim_id, secret):
+    """ Returns the signed payload of a bluesky-auth request. """
+    req = dict(simulationType=sim_type, simulationId=sim_id)
+    r = random.SystemRandom()
+    req['authNonce'] = str(int(time.time())) + '-' + ''.join(r.choice(numconv.BASE62)
+                                                             for x in range(32))
+    h = hashlib.sha256()
+    h.update(':'.join([req['authNonce'], req['simulationType'],
+                       req['simulationId'], secret]).encode())
+    req['authHash'] = 'v1:' + base64.urlsafe_b64encode(h.digest()).decode()
+    return req
 
 
 class SirepoBluesky(object):
@@ -14,6 +182,24 @@ class SirepoBluesky(object):
     ----------
     server: str
         Sirepo server to call, ex. 'http://locahost:8000'
+    secret: str, optional
+        Secret key shared with the server. Defaults to 'bluesky'.
+    session: requests.Session, optional
+        Session used for all the requests. A pooled keep-alive session is
+        created if not provided. Copies returned by copy_sim() share it.
+    pool_size: int, optional
+        Maximum number of keep-alive connections kept by the created session.
+        Defaults is 10.
+    polling: PollingPolicy, optional
+        Default policy of the status calls made by run_simulation().
+    timings: PhaseTimings, optional
+        Histograms of the durations of the requests, per endpoint, and of
+        the runs ('simulation'). Created if not provided, copies returned by
+        copy_sim() share it.
+    cache: SimulationCache, optional
+        Local cache of the datafiles. If the inputs of a run are found in it,
+        run_simulation() doesn't call the server and the datafile is read from
+        the cache. Copies returned by copy_sim() share it.
 
     Examples
     --------
@@ -35,6 +221,12 @@ class SirepoBluesky(object):
     sb.run_simulation()
     f2 = sb.get_datafile()
 
+    # or stream it to a file, without holding it in memory
+    md5 = sb.download_datafile('/tmp/W1.dat')
+
+    # check that the connections were reused
+    sb.connection_stats()
+
     Start Sirepo Server
     -------------------
     $ SIREPO_BLUESKY_AUTH_SECRET=bluesky sirepo service http
@@ -42,21 +234,28 @@ class SirepoBluesky(object):
 
     """
 
-    def __init__(self, server, secret='bluesky'):
+    def __init__(self, server, secret='bluesky', session=None, pool_size=10, polling=None, cache=None,
+                 timings=None):
         self.server = server
         self.secret = secret
+        self.cache = cache
+        if timings is None:
+            timings = PhaseTimings(server)
+        self.timings = timings
+        if polling is None:
+            polling = PollingPolicy()
+        self.polling = polling
+        self.last_run_stats = None
+        # cache key of the last run and, if it was a cache hit, its datafile
+        self._run_key = None
+        self._cached_datafile = None
+        if session is None:
+            session = create_session(pool_size)
+        self.session = session
 
     def auth(self, sim_type, sim_id):
         """ Connect to the server and returns the data for the simulation identified by sim_id. """
-        req = dict(simulationType=sim_type, simulationId=sim_id)
-        r = random.SystemRandom()
-        req['authNonce'] = str(int(time.time())) + '-' + ''.join(r.choice
-                                        (numconv.BASE62) for x in range(32))
-        h = hashlib.sha256()
-        h.update(':'.join([req['authNonce'], req['simulationType'],
-                           req['simulationId'], self.secret]).encode())
-        req['authHash'] = 'v1:' + base64.urlsafe_b64encode(h.digest()).decode()
-
+        req = auth_request(sim_type, sim_id, self.secret)
         self.cookies = None
         res = self._post_json('bluesky-auth', req)
         assert 'state' in res and res['state'] == 'ok', 'bluesky_auth failed: {}'.format(res)
@@ -76,7 +275,8 @@ class SirepoBluesky(object):
             'folder': self.data['models']['simulation']['folder'],
             'name': sim_name,
         })
-        copy = SirepoBluesky(self.server, self.secret)
+        copy = SirepoBluesky(self.server, self.secret, session=self.session, polling=self.polling,
+                             cache=self.cache, timings=self.timings)
         copy.cookies = self.cookies
         copy.sim_type = self.sim_type
         copy.sim_id = res['models']['simulation']['simulationId']
@@ -95,6 +295,16 @@ class SirepoBluesky(object):
         assert res['state'] == 'ok'
         self.sim_id = None
 
+    def connection_stats(self):
+        """ Returns the number of requests sent and connections opened and reused by the session. """
+        adapters = {id(a): a for a in self.session.adapters.values()
+                    if isinstance(a, CountingHTTPAdapter)}.values()
+        requests_sent = sum(a.requests_sent for a in adapters)
+        opened = sum(a.connections_opened for a in adapters)
+        return {'requests': requests_sent,
+                'connections_opened': opened,
+                'connections_reused': requests_sent - opened}
+
     @staticmethod
     def find_element(elements, field, value):
         """ Helper method to lookup an element in an array by field value. """
@@ -113,40 +323,131 @@ class SirepoBluesky(object):
         """ Requests the raw datafile of simulation results from the server.
         Call auth() and run_simulation() before this. """
         assert hasattr(self, 'cookies'), 'call auth() before get_datafile()'
-        url = 'download-data-file/{}/{}/{}/-1'.format(self.sim_type, self.sim_id, self.data['report'])
-        response = requests.get('{}/{}'.format(self.server, url), cookies=self.cookies)
+        if self._cached_datafile is not None:
+            return self._cached_datafile
+        url = self._datafile_url()
+        with self.timings.time('download-data-file'):
+            response = self.session.get('{}/{}'.format(self.server, url), cookies=self.cookies)
         self._assert_success(response, url)
+        self._store_datafile(content=response.content)
         return response.content
 
-    def run_simulation(self, max_status_calls=1000):
+    def download_datafile(self, filename, chunk_size=1024 * 1024, hash_name='md5', buffer=None):
+        """ Streams the raw datafile of simulation results to filename and returns its hex digest.
+        Call auth() and run_simulation() before this.
+
+        Parameters
+        ----------
+        filename: str or Path
+            File to write the data to.
+        chunk_size: int, optional
+            Number of bytes written at once. Defaults is 1 MiB.
+        hash_name: str, optional
+            Name of the hashlib algorithm used for the digest. Defaults is 'md5'.
+        buffer: file-like object, optional
+            Also receives the data, e.g. an io.BytesIO to parse it without
+            reading the file back.
+
+        """
+        assert hasattr(self, 'cookies'), 'call auth() before download_datafile()'
+        if self._cached_datafile is not None:
+            return self._write_cached_datafile(filename, hash_name, buffer)
+        h = hashlib.new(hash_name)
+        url = self._datafile_url()
+        with self.timings.time('download-data-file'), \
+                self.session.get('{}/{}'.format(self.server, url), cookies=self.cookies, stream=True) as response:
+            self._assert_success(response, url)
+            with open(filename, 'wb') as f:
+                for chunk in response.iter_content(chunk_size):
+                    h.update(chunk)
+                    f.write(chunk)
+                    if buffer is not None:
+                        buffer.write(chunk)
+        self._store_datafile(filename=filename)
+        return h.hexdigest()
+
+    def run_simulation(self, max_status_calls=1000, polling=None):
         """ Run the sirepo simulation and returns the formatted plot data.
 
+        The number of status calls, the elapsed time and an upper bound of the
+        time between the end of the run and its detection are stored in
+        last_run_stats. If the inputs are found in the cache, the server is not
+        called and {'state': 'completed', 'cached': True} is returned. The
+        cached datafile is read at once and returned by get_datafile(), even
+        if it is evicted in the meantime.
+
         Parameters
         ----------
         max_status_calls: int, optional
-            Maximum calls to check a running simulation's status. Roughly in seconds.
+            Maximum calls to check a running simulation's status.
             Defaults is 1000.
+        polling: PollingPolicy, optional
+            Policy of the status calls. Defaults to self.polling.
 
         """
-        assert hasattr(self, 'cookies'), 'call auth() before run_simulation()'
-        assert 'report' in self.data, 'client needs to set data[\'report\']'
-        self.data['simulationId'] = self.sim_id
+        tracker = self._start_run(polling)
+        if tracker is None:
+            return {'state': 'completed', 'cached': True}
         res = self._post_json('run-simulation', self.data)
+        tracker.received(res['state'], status_call=False)
         for _ in range(max_status_calls):
             state = res['state']
             if state == 'completed' or state == 'error':
                 break
-            time.sleep(res['nextRequestSeconds'])
+            time.sleep(tracker.next_delay())
             res = self._post_json('run-status', res['nextRequest'])
-        assert state == 'completed', 'simulation failed to completed: {}'.format(state)
+            tracker.received(res['state'])
+        self._finish_run(tracker, state)
         return res
 
+    # the helpers below do not call the server, AsyncSirepoBluesky shares them
+
+    def _start_run(self, polling=None):
+        """ Prepares a run and returns the tracker of its status calls, or None if the
+        datafile of the inputs is in the cache. """
+        assert hasattr(self, 'cookies'), 'call auth() before run_simulation()'
+        assert 'report' in self.data, 'client needs to set data[\'report\']'
+        self.data['simulationId'] = self.sim_id
+        tracker = (polling or self.polling).start()
+        self._run_key = None
+        self._cached_datafile = None
+        if self.cache is not None:
+            self._run_key = self.cache.key(self.sim_type, self.data)
+            # read now: the file could be evicted by another client before get_datafile()
+            self._cached_datafile = self.cache.read(self._run_key)
+            if self._cached_datafile is not None:
+                self.last_run_stats = dict(tracker.stats(), cached=True)
+                return None
+        return tracker
+
+    def _finish_run(self, tracker, state):
+        self.last_run_stats = tracker.stats()
+        self.timings.record('simulation', self.last_run_stats['elapsed'])
+        assert state == 'completed', 'simulation failed to completed: {}'.format(state)
+
+    def _datafile_url(self):
+        return 'download-data-file/{}/{}/{}/-1'.format(self.sim_type, self.sim_id, self.data['report'])
+
+    def _store_datafile(self, content=None, filename=None):
+        """ Stores the downloaded datafile of the last run in the cache, if any. """
+        if self._run_key is not None:
+            self.cache.put(self._run_key, content=content, filename=filename)
+
+    def _write_cached_datafile(self, filename, hash_name, buffer):
+        """ Writes the datafile of a cache hit like download_datafile() and returns its hex digest. """
+        with open(filename, 'wb') as f:
+            f.write(self._cached_datafile)
+        if buffer is not None:
+            buffer.write(self._cached_datafile)
+        return hashlib.new(hash_name, self._cached_datafile).hexdigest()
+
     @staticmethod
     def _assert_success(response, url):
         assert response.status_code == requests.codes.ok, '{} request failed, status: {}'.format(url, response.status_code)
 
     def _post_json(self, url, payload):
-        response = requests.post('{}/{}'.format(self.server, url), json=payload, cookies=self.cookies)
+        with self.timings.time(url):
+            response = self.session.post('{}/{}'.format(self.server, url), json=payload, cookies=self.cookies)
         self._assert_success(response, url)
         if not self.cookies:
             self.cookies = response.cookies
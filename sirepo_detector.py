@@ -1,13 +1,53 @@
 import datetime
+import numbers
+import os
+import time as ttime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import unyt as u
 
 from ophyd import Device, Signal, Component as Cpt
+from ophyd.status import DeviceStatus
 from ophyd.sim import SynAxis, NullStatus, new_uid
 
-from srw_handler import read_srw_file
-from sirepo_bluesky import SirepoBluesky
+from lookahead import Lookahead, positions_from_plan
+from srw_handler import BEAM_STATISTICS, ImageTransform, read_srw_file
+from sharded_sirepo_bluesky import create_client
+from timing import PhaseTimings
+
+
+class SirepoAxis(SynAxis):
+    """
+    SynAxis holding the value of a field of a Sirepo model.
+
+    Sirepo fields are not always numbers (e.g. 'title', 'shape' or numbers
+    stored as strings), such values are set immediately instead of being
+    moved to.
+    """
+
+    def set(self, value):
+        old_setpoint = self.sim_state['setpoint']
+        if isinstance(value, numbers.Number) and isinstance(old_setpoint, numbers.Number):
+            return super().set(value)
+        old_readback = self.sim_state['readback']
+        now = ttime.time()
+        self.sim_state.update(setpoint=value, setpoint_ts=now, readback=value, readback_ts=now)
+        self.setpoint._run_subs(sub_type=self.setpoint.SUB_VALUE, old_value=old_setpoint,
+                                value=value, timestamp=now)
+        self.readback._run_subs(sub_type=self.readback.SUB_VALUE, old_value=old_readback,
+                                value=value, timestamp=now)
+        return NullStatus()
+
+
+def _write_file(filename, content):
+    if isinstance(content, np.ndarray):
+        np.save(filename, content)
+        return
+    with open(filename, 'wb') as f:
+        f.write(content)
 
 
 class SirepoDetector(Device):
@@ -21,16 +61,38 @@ class SirepoDetector(Device):
     ----------
     name : str
         The name of the detector
-    reg : Databroker registry
+    reg : Databroker registry, optional
+        If given, the resources and datums are inserted into it directly, as
+        before. By default they are emitted as documents by
+        collect_asset_docs(), for the subscribers of the RunEngine.
     sim_id : str
         The simulation id corresponding to the Sirepo simulation being run on
         local server
     watch_name : str
         The name of the watchpoint viewing the simulation
-    sirepo_server : str
-        Address that identifies access to local Sirepo server
+    sirepo_server : str or list of str
+        Address that identifies access to local Sirepo server, or addresses
+        of several servers to spread the runs on, see ShardedSirepoBluesky
     source_simulation : bool
         States whether user wants to grab source page info instead of beamline
+    cache : SimulationCache, optional
+        Local cache of the simulation results, so repeated configurations
+        are not run again on the server
+    resource_per_stage : bool, optional
+        Emit one resource per stage, the directory of the datafiles, with a
+        datum per trigger, instead of one resource per trigger. Only used
+        without reg.
+    dtype, binning, roi : optional
+        Transform of the stored images, see srw_handler.ImageTransform. The
+        transformed image is stored as a .npy file instead of the SRW file.
+        The shape and extents describe the transformed image, the mean and
+        the beam statistics are computed on the full image.
+
+    The duration of each phase of the last trigger is in the duration_*
+    signals, omitted from the readings unless added to read_attrs, and all
+    the durations are aggregated in the histograms of timings (see
+    timing.PhaseTimings). The requests to the server are timed by
+    sb.timings.
 
     """
     image = Cpt(Signal)
@@ -39,9 +101,25 @@ class SirepoDetector(Device):
     photon_energy = Cpt(Signal)
     horizontal_extent = Cpt(Signal)
     vertical_extent = Cpt(Signal)
+    # beam statistics, see srw_handler.beam_statistics()
+    peak = Cpt(Signal)
+    flux = Cpt(Signal)
+    centroid_x = Cpt(Signal)
+    centroid_y = Cpt(Signal)
+    rms_x = Cpt(Signal)
+    rms_y = Cpt(Signal)
+    fwhm_x = Cpt(Signal)
+    fwhm_y = Cpt(Signal)
+    # durations in seconds of the phases of the last trigger
+    duration_run = Cpt(Signal, kind='omitted')
+    duration_download = Cpt(Signal, kind='omitted')
+    duration_read = Cpt(Signal, kind='omitted')
+    duration_register = Cpt(Signal, kind='omitted')
+    duration_total = Cpt(Signal, kind='omitted')
 
     def __init__(self, name='sirepo_det', reg=None, sim_id=None, watch_name=None,
-                 sirepo_server='http://10.10.10.10:8000', source_simulation=False, **kwargs):
+                 sirepo_server='http://10.10.10.10:8000', source_simulation=False, cache=None,
+                 dtype=None, binning=None, roi=None, resource_per_stage=False, **kwargs):
         super().__init__(name=name, **kwargs)
         self.reg = reg
         self.sirepo_component = None
@@ -62,9 +140,30 @@ class SirepoDetector(Device):
         self.sirepo_components = None
         self.source_component = None
         self.active_parameters = {}
+        # (parameter, optic title, field) of the parameters created by create_parameter()
+        self._parameter_fields = []
+        # optic title -> index in data['models']['beamline']
+        self._optic_ids = {}
+        # last value written into the model for each (optic title, field)
+        self._written = {}
+        # whether the readings match the model, so the next trigger can skip the run
+        self._up_to_date = False
+        self._lookahead = None
+        self.root_dir = '/tmp/data'
+        self.resource_per_stage = resource_per_stage
+        self._asset_docs_cache = deque()
+        # (uid, directory) of the resource of the current stage
+        self._stage_resource = None
         self.source_simulation = source_simulation
+        self.cache = cache
+        self.transform = ImageTransform(dtype=dtype, binning=binning, roi=roi)
         self.one_d_reports = ['intensityReport']
         self.two_d_reports = ['watchpointReport']
+        self.timings = PhaseTimings(name)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # the datafiles are written to disk while the reductions are computed
+        # from the downloaded bytes
+        self._file_writer = ThreadPoolExecutor(max_workers=1)
         assert sim_id, 'Simulation ID must be provided. Currently it is set to {}'.format(sim_id)
         self.connect(sim_id=self._sim_id)
 
@@ -91,8 +190,10 @@ class SirepoDetector(Device):
     def update_parameters(self):
         data, sirepo_schema = self.sb.auth('srw', self._sim_id)
         self.data = data
+        self._index_beamline()
+        self.invalidate()
         for key, value in self.sirepo_components.items():
-            optic_id = self.sb.find_optic_id_by_name(key)
+            optic_id = self._optic_ids[key]
             self.parameters = {f'sirepo_{k}': v for k, v in
                                data['models']['beamline'][optic_id].items()}
             for k, v in self.parameters.items():
@@ -101,102 +202,274 @@ class SirepoDetector(Device):
     def trigger(self):
         super().trigger()
         datum_id = new_uid()
-        date = datetime.datetime.now()
-        srw_file = Path('/tmp/data') / Path(date.strftime('%Y/%m/%d')) / \
-                   Path('{}.dat'.format(datum_id))
+        if self._stage_resource is not None:
+            data_dir = self._stage_resource[1]
+        else:
+            data_dir = self._data_dir()
+        # with a transform, only the transformed image is stored
+        srw_file = data_dir / Path('{}.{}'.format(datum_id, 'dat' if self.transform.is_identity else 'npy'))
 
+        report = self.data.get('report')
+        values = []
         if not self.source_simulation:
             if self.sirepo_component is not None:
-                for i in range(len(self.active_parameters)):
-                    real_field = self.fields['field' + str(i)].replace('sirepo_', '')
-                    dict_key = self.fields['field' + str(i)].replace('sirepo', self.parents['par' + str(i)])
-                    x = self.active_parameters[dict_key].read()[
-                        f'{self.parents["par" + str(i)]}_{self.fields["field" + str(i)]}']['value']
-                    element = self.sb.find_element(self.data['models']['beamline'],
-                                                   'title',
-                                                   self.parents['par' + str(i)])
-                    element[real_field] = x
-
-                watch = self.sb.find_element(self.data['models']['beamline'],
-                                             'title',
-                                             self.watch_name)
-                self.data['report'] = 'watchpointReport{}'.format(watch['id'])
+                # only the fields which changed since the last trigger are written
+                for param, title, field in self._parameter_fields:
+                    x = param.readback.get()
+                    values.append(x)
+                    key = (title, field)
+                    if key not in self._written or self._written[key] != x:
+                        self._element(title)[field] = x
+                        self._written[key] = x
+                        self._up_to_date = False
+
+                watch = self._element(self.watch_name)
+                report = 'watchpointReport{}'.format(watch['id'])
 
         else:
-            self.data['report'] = "intensityReport"
-        self.sb.run_simulation()
-
-        with open(srw_file, 'wb') as f:
-            f.write(self.sb.get_datafile())
+            report = "intensityReport"
+        if self.data.get('report') != report:
+            self.data['report'] = report
+            self._up_to_date = False
+
+        future = None
+        if self._lookahead is not None:
+            future = self._lookahead.take(values, report)
+
+        status = DeviceStatus(self)
+        if self._up_to_date:
+            # nothing changed since the last run, the readings are still valid
+            status.set_finished()
+            return status
+
+        # the run, the download and the reductions happen in the background,
+        # the readings are updated before the status finishes
+
+        def finished(future):
+            exc = future.exception()
+            if exc is None:
+                status.set_finished()
+            else:
+                status.set_exception(exc)
+
+        self._executor.submit(self._acquire, datum_id, srw_file, future,
+                              ttime.perf_counter()).add_done_callback(finished)
+        return status
+
+    def _acquire(self, datum_id, srw_file, future=None, start=None):
+        durations = {}
+        t0 = ttime.perf_counter()
+        if start is None:
+            start = t0
+        if future is None:
+            self.sb.run_simulation()
+            t1 = ttime.perf_counter()
+            content = self.sb.get_datafile()
+        else:
+            # the point was run ahead by prefetch()
+            content = future.result()
+            t1 = ttime.perf_counter()
+        durations['run'] = t1 - t0
+        durations['download'] = ttime.perf_counter() - t1
+        if self.transform.is_identity:
+            write = self._file_writer.submit(self._write_file, srw_file, content)
 
         if self.data['report'] in self.one_d_reports:
             ndim = 1
         else:
             ndim = 2
-        ret = read_srw_file(srw_file, ndim=ndim)
+        t0 = ttime.perf_counter()
+        ret = read_srw_file(content, ndim=ndim)
+        durations['read'] = ttime.perf_counter() - t0
+        if not self.transform.is_identity:
+            write = self._file_writer.submit(self._write_file, srw_file, self.transform(ret['data']))
+        # the readings must not refer to a file which is missing, a failed write fails the trigger
+        write.result()
 
         self.image.put(datum_id)
-        self.shape.put(ret['shape'])
+        horizontal_extent, vertical_extent = ret['horizontal_extent'], ret['vertical_extent']
+        if ndim == 2 and not self.transform.is_identity:
+            horizontal_extent, vertical_extent = self.transform.extents(horizontal_extent, vertical_extent,
+                                                                        ret['shape'])
+        self.shape.put(self.transform.transformed_shape(ret['shape']))
         self.mean.put(ret['mean'])
         self.photon_energy.put(ret['photon_energy'])
-        self.horizontal_extent.put(ret['horizontal_extent'])
-        self.vertical_extent.put(ret['vertical_extent'])
-
-        self._resource_id = self.reg.insert_resource('srw', srw_file, {'ndim': ndim})
-        self.reg.insert_datum(self._resource_id, datum_id, {})
-
-        return NullStatus()
+        self.horizontal_extent.put(horizontal_extent)
+        self.vertical_extent.put(vertical_extent)
+        for key in BEAM_STATISTICS:
+            getattr(self, key).put(ret[key])
+
+        t0 = ttime.perf_counter()
+        self._register(srw_file, datum_id, ndim)
+        durations['register'] = ttime.perf_counter() - t0
+        # from the call to trigger(), including the wait for the previous trigger
+        durations['total'] = ttime.perf_counter() - start
+        for phase, duration in durations.items():
+            getattr(self, 'duration_' + phase).put(duration)
+            self.timings.record(phase, duration)
+        self._up_to_date = True
+
+    def _data_dir(self):
+        return Path(self.root_dir) / Path(datetime.datetime.now().strftime('%Y/%m/%d'))
+
+    def _resource(self, resource_path, ndim):
+        resource = {'spec': 'srw',
+                    'root': self.root_dir,
+                    'resource_path': str(Path(resource_path).relative_to(self.root_dir)),
+                    'resource_kwargs': dict(self.transform.resource_kwargs(), ndim=ndim),
+                    'path_semantics': {'posix': 'posix', 'nt': 'windows'}[os.name],
+                    'uid': new_uid()}
+        self._asset_docs_cache.append(('resource', resource))
+        return resource['uid']
+
+    def _register(self, srw_file, datum_id, ndim):
+        if self.reg is not None:
+            self._resource_id = self.reg.insert_resource(
+                'srw', srw_file, dict(self.transform.resource_kwargs(), ndim=ndim))
+            self.reg.insert_datum(self._resource_id, datum_id, {})
+            return
+        if self._stage_resource is not None:
+            datum_kwargs = {'filename': srw_file.name}
+            self._resource_id = self._stage_resource[0]
+        else:
+            datum_kwargs = {}
+            self._resource_id = self._resource(srw_file, ndim)
+        self._asset_docs_cache.append(('datum', {'resource': self._resource_id,
+                                                 'datum_kwargs': datum_kwargs,
+                                                 'datum_id': datum_id}))
+
+    def collect_asset_docs(self):
+        items = list(self._asset_docs_cache)
+        self._asset_docs_cache.clear()
+        for item in items:
+            yield item
+
+    def _write_file(self, filename, content):
+        with self.timings.time('write'):
+            _write_file(filename, content)
+
+    def prefetch(self, positions, depth=4):
+        """
+        Runs the upcoming points of a step scan ahead, on copies of the simulation.
+
+        Up to depth points run at once on the server while the current one is
+        read out. trigger() uses the result of the next point if the
+        parameters are at its values, and runs the simulation itself
+        otherwise. The copies are deleted by cancel_prefetch(), also called by
+        unstage().
+
+        Parameters
+        ----------
+        positions : sequence
+            Values of the parameters returned by create_parameter(), in the
+            order they were created, at each upcoming trigger. Single values
+            are accepted when there is one parameter.
+        depth : int, optional
+            Maximum number of points running at once. Defaults is 4.
+
+        Examples
+        --------
+        sirepo_det.prefetch(np.linspace(0, 1, 10))
+        RE(bp.scan([sirepo_det], param1, 0, 1, 10))
+
+        """
+        assert not self.source_simulation, 'prefetch() needs a beamline simulation'
+        self.cancel_prefetch()
+        positions = [tuple(p) if isinstance(p, (tuple, list, np.ndarray)) else (p,) for p in positions]
+        report = 'watchpointReport{}'.format(self._element(self.watch_name)['id'])
+        self._lookahead = Lookahead(self.sb, [(title, field) for _, title, field in self._parameter_fields],
+                                    positions, report, depth=depth)
+
+    def prefetch_plan(self, plan, depth=4):
+        """ Runs the points of plan ahead, see prefetch(). The plan is consumed, pass a new one to the RunEngine.
+
+        Examples
+        --------
+        sirepo_det.prefetch_plan(bp.grid_scan([sirepo_det], param1, 0, 1, 10, param2, 0, 1, 10, True))
+        RE(bp.grid_scan([sirepo_det], param1, 0, 1, 10, param2, 0, 1, 10, True))
+
+        """
+        parameters = [param for param, _, _ in self._parameter_fields]
+        self.prefetch(positions_from_plan(plan, self, parameters), depth=depth)
+
+    def close(self):
+        """ Stops running points ahead and the threads of the detector, after the trigger in progress. """
+        self.cancel_prefetch()
+        self._executor.shutdown(wait=True)
+        self._file_writer.shutdown(wait=True)
+
+    def cancel_prefetch(self):
+        """ Stops running points ahead and deletes the copies. """
+        if self._lookahead is not None:
+            self._lookahead.close()
+            self._lookahead = None
+
+    def invalidate(self):
+        """ Forces the next trigger to run the simulation, e.g. after editing self.data directly. """
+        self._up_to_date = False
+
+    def _index_beamline(self):
+        self._optic_ids = {}
+        for i, element in enumerate(self.data['models']['beamline']):
+            self._optic_ids.setdefault(element['title'], i)
+        self._written = {}
+
+    def _element(self, title):
+        try:
+            return self.data['models']['beamline'][self._optic_ids[title]]
+        except KeyError:
+            raise ValueError(f'Not valid optic {title}') from None
 
     def describe(self):
         res = super().describe()
         res[self.image.name].update(dict(external="FILESTORE"))
         return res
 
+    def flush(self):
+        """ Waits until the previous triggers are done and their datafiles written to disk. """
+        self._executor.submit(lambda: None).result()
+
+    def stage(self):
+        ret = super().stage()
+        if self.reg is None:
+            # the datums of a run must refer to its own resources, so the first trigger runs
+            self.invalidate()
+        if self.reg is None and self.resource_per_stage:
+            data_dir = self._data_dir()
+            ndim = 1 if self.source_simulation else 2
+            self._stage_resource = (self._resource(data_dir, ndim), data_dir)
+        return ret
+
     def unstage(self):
+        self.cancel_prefetch()
+        self.flush()
         super().unstage()
+        # a resource of this stage that no event refers to must not go to the next run
+        self._asset_docs_cache.clear()
         self._resource_id = None
+        self._stage_resource = None
         self._result.clear()
 
     def connect(self, sim_id):
-        sb = SirepoBluesky(self.sirepo_server)
+        sb = create_client(self.sirepo_server, cache=self.cache)
         data, sirepo_schema = sb.auth('srw', sim_id)
         self.data = data
         self.sb = sb
+        self._index_beamline()
+        self.invalidate()
         if not self.source_simulation:
-
-            def class_factory(cls_name):
-                dd = {k: Cpt(SynAxis) for k in self.parameters}
-                return type(cls_name, (Device,), dd)
-
-            sirepo_components = {}
-
-            # Create sirepo component for each optical element, set active element
-            # to the one selected by the user
-            for i in range(len(data['models']['beamline'])):
-                optic = (data['models']['beamline'][i]['title'])
-                optic_id = self.sb.find_optic_id_by_name(optic)
-
-                self.parameters = {f'sirepo_{k}': v for k, v in
-                                   data['models']['beamline'][optic_id].items()}
-
-                self.optic_parameters[optic] = self.parameters
-
-                SirepoComponent = class_factory('SirepoComponent')
-                sirepo_component = SirepoComponent(name=optic)
-
-                for k, v in self.parameters.items():
-                    getattr(sirepo_component, k).set(v)
-
-                sirepo_components[sirepo_component.name] = sirepo_component
-
-            self.sirepo_components = sirepo_components
+            # the components are created on demand by select_optic(), see _get_component()
+            self.sirepo_components = {}
+            for optic, optic_id in self._optic_ids.items():
+                self.optic_parameters[optic] = {f'sirepo_{k}': v for k, v in
+                                                data['models']['beamline'][optic_id].items()}
 
         else:
             # Create source components
             self.source_parameters = {f'sirepo_intensityReport_{k}': v for k, v in
                                       data['models']['intensityReport'].items()}
             def source_class_factory(cls_name):
-                dd = {k: Cpt(SynAxis) for k in self.source_parameters}
+                dd = {k: Cpt(SirepoAxis) for k in self.source_parameters}
                 return type(cls_name, (Device,), dd)
 
             SirepoComponent = source_class_factory('SirepoComponent')
@@ -232,7 +505,19 @@ class SirepoDetector(Device):
         name of optic 
     """
     def select_optic(self, name):
-        self.sirepo_component = self.sirepo_components[name]
+        self.sirepo_component = self._get_component(name)
+
+    def _get_component(self, name):
+        """ Returns the component of the optic name, created on first use with an axis per field. """
+        if name not in self.sirepo_components:
+            parameters = {f'sirepo_{k}': v for k, v in self._element(name).items()}
+            SirepoComponent = type('SirepoComponent', (Device,),
+                                   {k: Cpt(SirepoAxis) for k in parameters})
+            sirepo_component = SirepoComponent(name=name)
+            for k, v in parameters.items():
+                getattr(sirepo_component, k).set(v)
+            self.sirepo_components[name] = sirepo_component
+        return self.sirepo_components[name]
 
     """
     Returns a parameter based on Ophyd objects created in connect() 
@@ -257,6 +542,7 @@ class SirepoDetector(Device):
         key = f"{self.parents[parentkey]}_{name}"
         param = getattr(self.sirepo_component, real_name)
         self.active_parameters[key] = param
+        self._parameter_fields.append((param, self.sirepo_component.name, name))
 
         return param
 
@@ -278,7 +564,7 @@ class SirepoDetector(Device):
     
      % run -i re_config.py
      import sirepo_detector as sd
-     sirepo_det = sd.SirepoDetector(sim_id='qyQ4yILz', reg=db.reg)
+     sirepo_det = sd.SirepoDetector(sim_id='qyQ4yILz')
      sirepo_det.select_optic('Aperture')
      param1 = sirepo_det.create_parameter('horizontalSize')
      param2 = sirepo_det.create_parameter('verticalSize')
@@ -312,7 +598,7 @@ class SirepoDetector(Device):
     
     % run -i re_config.py
     import sirepo_detector as sd
-    sirepo_det = sd.SirepoDetector(sim_id='8GJJWLFh', reg=db.reg, source_simulation=True)
+    sirepo_det = sd.SirepoDetector(sim_id='8GJJWLFh', source_simulation=True)
     sirepo_det.read_attrs = ['image', 'mean', 'photon_energy']
     sirepo_det.configuration_attrs = ['horizontal_extent', 'vertical_extent', 'shape']
     
@@ -1,15 +1,23 @@
 import datetime
 import hashlib
+import io
 import os
+import threading
 import time as ttime
 from collections import deque
-from multiprocessing import Process, Manager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 from ophyd.sim import NullStatus, new_uid
 
-from sirepo_bluesky import SirepoBluesky
-from srw_handler import read_srw_file
+from sharded_sirepo_bluesky import create_client
+from timing import PhaseTimings
+from srw_handler import BEAM_STATISTICS, ImageTransform, SRWContainerWriter, read_srw_file
+
+
+# per copy, in seconds
+DURATIONS = ('duration_run', 'duration_download', 'duration_read')
 
 
 class BlueskyFlyer:
@@ -38,7 +46,9 @@ class BlueskyFlyer:
 
 class SirepoFlyer(BlueskyFlyer):
     def __init__(self, sim_id, server_name, params_to_change, root_dir, sim_code='srw',
-                 watch_name='Watchpoint', run_parallel=True):
+                 watch_name='Watchpoint', run_parallel=True, cache=None, copy_pool=None, max_concurrency=10,
+                 container=None, dtype=None, binning=None, roi=None, record_durations=False, timings=None,
+                 max_workers=None):
         super().__init__()
         self.name = 'sirepo_flyer'
         self._sim_id = sim_id
@@ -49,7 +59,24 @@ class SirepoFlyer(BlueskyFlyer):
         self._copy_count = len(self.params_to_change)
         self._watch_name = watch_name
         self._run_parallel = run_parallel
+        self._cache = cache
+        self._copy_pool = copy_pool
+        # runs the copies with run_parallel, kept alive between kickoffs
+        self._run_executor = None
+        self.max_concurrency = max_concurrency
+        self.max_workers = max_workers
+        self._container = container
+        self._container_file = None
+        self._transform = ImageTransform(dtype=dtype, binning=binning, roi=roi)
+        self.record_durations = record_durations
         self.return_status = {}
+        # durations of the phases of the last kickoff
+        self.last_durations = {}
+        # histograms of the durations of all the kickoffs, per copy and per request
+        if timings is None:
+            timings = PhaseTimings(self.name)
+        self.timings = timings
+        self._run_durations = {}
         self._copies = None
         self._srw_files = None
     
@@ -130,65 +157,221 @@ class SirepoFlyer(BlueskyFlyer):
         else:
             raise TypeError(f'invalid type: {type(value)}. Must be boolean')
 
+    @property
+    def cache(self):
+        return self._cache
+
+    @cache.setter
+    def cache(self, value):
+        self._cache = value
+
+    @property
+    def copy_pool(self):
+        return self._copy_pool
+
+    @copy_pool.setter
+    def copy_pool(self, value):
+        self._copy_pool = value
+
+    @property
+    def max_concurrency(self):
+        return self._max_concurrency
+
+    @max_concurrency.setter
+    def max_concurrency(self, value):
+        value = int(value)
+        if value < 1:
+            raise ValueError(f'invalid value: {value}. Must be at least 1')
+        self._max_concurrency = value
+
+    @property
+    def max_workers(self):
+        """ Number of copies run at once with run_parallel, max_concurrency by default. """
+        if self._max_workers is None:
+            return self.max_concurrency
+        return self._max_workers
+
+    @max_workers.setter
+    def max_workers(self, value):
+        if value is not None:
+            value = int(value)
+            if value < 1:
+                raise ValueError(f'invalid value: {value}. Must be at least 1')
+        # the pool is created again with the new size at the next kickoff
+        self.close()
+        self._max_workers = value
+
+    def close(self):
+        """ Stops the threads running the copies, after the runs in progress. """
+        if self._run_executor is not None:
+            self._run_executor.shutdown(wait=True)
+            self._run_executor = None
+
+    @property
+    def container(self):
+        return self._container
+
+    @container.setter
+    def container(self, value):
+        if value not in (None, 'hdf5'):
+            raise ValueError(f'invalid container: {value}. Must be None or "hdf5"')
+        self._container = value
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, value):
+        if value is None:
+            value = ImageTransform()
+        if not isinstance(value, ImageTransform):
+            raise ValueError(f'invalid transform: {value}. Must be an ImageTransform or None')
+        self._transform = value
+
+    @property
+    def record_durations(self):
+        return self._record_durations
+
+    @record_durations.setter
+    def record_durations(self, value):
+        self._record_durations = bool(value)
+
     def kickoff(self):
-        sb = SirepoBluesky(self.server_name)
-        data, schema = sb.auth(self.sim_code, self.sim_id)
+        if self._copy_pool is not None:
+            sb = self._copy_pool.sb
+        else:
+            # a keep-alive connection for each thread of the flyer
+            sb = create_client(self.server_name, cache=self._cache, timings=self.timings,
+                               pool_size=max(self.max_workers, self.max_concurrency))
+            data, schema = sb.auth(self.sim_code, self.sim_id)
         self._copies = []
         self._srw_files = []
-
-        for i in range(self._copy_count):
-            datum_id = new_uid()
-            date = datetime.datetime.now()
-            srw_file = str(Path(self.root_dir) / Path(date.strftime('%Y/%m/%d')) / Path('{}.dat'.format(datum_id)))
-            self._srw_files.append(srw_file)
+        self._resource_uids = []
+        self._datum_ids = []
+        self.return_status = {}
+        self.last_durations = {}
+        self._run_durations = {}
+
+        if self._container is None:
+            for i in range(self._copy_count):
+                datum_id = new_uid()
+                date = datetime.datetime.now()
+                # with a transform, only the transformed image is stored
+                extension = 'dat' if self._transform.is_identity else 'npy'
+                srw_file = str(Path(self.root_dir) / Path(date.strftime('%Y/%m/%d')) /
+                               Path('{}.{}'.format(datum_id, extension)))
+                self._srw_files.append(srw_file)
+                _resource_uid = new_uid()
+                resource = {'spec': 'SIREPO_FLYER',
+                            'root': self.root_dir,  # from 00-startup.py (added by mrakitin for future generations :D)
+                            'resource_path': srw_file,
+                            'resource_kwargs': self._transform.resource_kwargs(),
+                            'path_semantics': {'posix': 'posix', 'nt': 'windows'}[os.name],
+                            'uid': _resource_uid}
+                self._resource_uids.append(_resource_uid)
+                self._asset_docs_cache.append(('resource', resource))
+        else:
+            # one file and one resource for all the frames
             _resource_uid = new_uid()
-            resource = {'spec': 'SIREPO_FLYER',
-                        'root': self.root_dir,  # from 00-startup.py (added by mrakitin for future generations :D)
-                        'resource_path': srw_file,
-                        'resource_kwargs': {},
+            date = datetime.datetime.now()
+            data_dir = Path(self.root_dir) / Path(date.strftime('%Y/%m/%d'))
+            self._container_file = str(data_dir / Path('{}.h5'.format(_resource_uid)))
+            resource = {'spec': 'SIREPO_FLYER_HDF5',
+                        'root': self.root_dir,
+                        'resource_path': self._container_file,
+                        'resource_kwargs': self._transform.resource_kwargs(),
                         'path_semantics': {'posix': 'posix', 'nt': 'windows'}[os.name],
                         'uid': _resource_uid}
             self._resource_uids.append(_resource_uid)
             self._asset_docs_cache.append(('resource', resource))
 
-        for param in self.params_to_change:
-            # name doesn't need to be unique, server will rename it
-            c1 = sb.copy_sim('{} Bluesky'.format(sb.data['models']['simulation']['name']), )
-            print('copy {}, {}'.format(c1.sim_id, c1.data['models']['simulation']['name']))
-
-            for key, parameters_to_update in param.items():
-                optic_id = sb.find_optic_id_by_name(key)
-                c1.data['models']['beamline'][optic_id].update(parameters_to_update)
-            watch = sb.find_element(c1.data['models']['beamline'], 'title', self.watch_name)
-            c1.data['report'] = 'watchpointReport{}'.format(watch['id'])
-            self._copies.append(c1)
+        start = ttime.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            self._copies = list(executor.map(lambda param: self._prepare_copy(sb, param),
+                                             self.params_to_change))
+        self.last_durations['copy'] = ttime.monotonic() - start
 
+        start = ttime.monotonic()
         if self.run_parallel:
-            manager = Manager()
-            self.return_status = manager.dict()
-            procs = []
-            for i in range(self.copy_count):
-                p = Process(target=self._run, args=(self._copies[i], self.return_status))
-                p.start()
-                procs.append(p)
-            # wait for procs to finish
-            for p in procs:
-                p.join()
+            if self._run_executor is None:
+                self._run_executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix=self.name)
+            # at most max_workers copies run at once, the others wait in the queue of the pool
+            futures = [self._run_executor.submit(self._run, c1) for c1 in self._copies]
+            results = [future.result() for future in futures]
         else:
             # run serial
-            for i in range(self.copy_count):
-                print(f'running sim: {self._copies[i].sim_id}')
-                status = self._copies[i].run_simulation()
-                print('Status:', status['state'])
-                self.return_status[self._copies[i].sim_id] = status['state']
+            results = [self._run(c1) for c1 in self._copies]
+        for c1, (state, elapsed) in zip(self._copies, results):
+            self.return_status[c1.sim_id] = state
+            self._run_durations[c1.sim_id] = elapsed
+        self.last_durations['run'] = ttime.monotonic() - start
         return NullStatus()
 
+    def _fetch_datafile(self, i, writer, writer_lock):
+        t0 = ttime.perf_counter()
+        if writer is None and self._transform.is_identity:
+            # streamed to the file and hashed chunk by chunk, the chunks are also kept to be parsed
+            buffer = io.BytesIO()
+            hash_value = self._copies[i].download_datafile(self._srw_files[i], buffer=buffer)
+            content = buffer.getvalue()
+        else:
+            content = self._copies[i].get_datafile()
+            hash_value = hashlib.md5(content).hexdigest()
+        t1 = ttime.perf_counter()
+        ret = read_srw_file(content)
+        if not self._transform.is_identity:
+            ret['horizontal_extent'], ret['vertical_extent'] = self._transform.extents(
+                ret['horizontal_extent'], ret['vertical_extent'], ret['shape'])
+            ret['data'] = self._transform(ret['data'])
+            ret['shape'] = ret['data'].shape
+        if writer is not None:
+            with writer_lock:
+                writer.write(i, ret['data'])
+        elif not self._transform.is_identity:
+            np.save(self._srw_files[i], ret['data'])
+        # only the reductions are kept, the frames are on disk
+        del ret['data']
+        ret['duration_download'] = t1 - t0
+        ret['duration_read'] = ttime.perf_counter() - t1
+        self.timings.record('download', ret['duration_download'])
+        self.timings.record('read', ret['duration_read'])
+        return hash_value, ret
+
+    def _prepare_copy(self, sb, param):
+        if self._copy_pool is not None:
+            c1 = self._copy_pool.acquire()
+        else:
+            # name doesn't need to be unique, server will rename it
+            c1 = sb.copy_sim('{} Bluesky'.format(sb.data['models']['simulation']['name']), )
+        print('copy {}, {}'.format(c1.sim_id, c1.data['models']['simulation']['name']))
+
+        for key, parameters_to_update in param.items():
+            optic_id = sb.find_optic_id_by_name(key)
+            c1.data['models']['beamline'][optic_id].update(parameters_to_update)
+        watch = sb.find_element(c1.data['models']['beamline'], 'title', self.watch_name)
+        c1.data['report'] = 'watchpointReport{}'.format(watch['id'])
+        return c1
+
+    def _delete_copy(self, c1):
+        if self._copy_pool is not None:
+            self._copy_pool.release(c1)
+        else:
+            c1.delete_copy()
+
     def complete(self, *args, **kwargs):
         for i in range(len(self._copies)):
-            datum_id = self._resource_uids[i]
-            datum = {'resource': self._resource_uids[i],
-                     'datum_kwargs': {},
-                     'datum_id': datum_id}
+            if self._container is None:
+                datum_id = self._resource_uids[i]
+                datum = {'resource': self._resource_uids[i],
+                         'datum_kwargs': {},
+                         'datum_id': datum_id}
+            else:
+                datum_id = f'{self._resource_uids[0]}/{i}'
+                datum = {'resource': self._resource_uids[0],
+                         'datum_kwargs': {'frame': i},
+                         'datum_id': datum_id}
             self._asset_docs_cache.append(('datum', datum))
             self._datum_ids.append(datum_id)
         return NullStatus()
@@ -222,6 +405,16 @@ class SirepoFlyer(BlueskyFlyer):
                                                  'shape': []},
                         }
                        }
+        for key in BEAM_STATISTICS:
+            return_dict[self.name][f'{self.name}_{key}'] = {'source': f'{self.name}_{key}',
+                                                            'dtype': 'number',
+                                                            'shape': []}
+        if self._record_durations:
+            for key in DURATIONS:
+                return_dict[self.name][f'{self.name}_{key}'] = {'source': f'{self.name}_{key}',
+                                                                'dtype': 'number',
+                                                                'shape': [],
+                                                                'units': 's'}
 
         elem_name = []
         curr_param = []
@@ -245,26 +438,40 @@ class SirepoFlyer(BlueskyFlyer):
         photon_energies = []
         horizontal_extents = []
         vertical_extents = []
-        hash_values = []
-        for i in range(len(self._copies)):
-            data_file = self._copies[i].get_datafile()
-            with open(self._srw_files[i], 'wb') as f:
-                f.write(data_file)
+        statistics = []
+        statuses = [self.return_status[c1.sim_id] for c1 in self._copies]
+
+        # the datafiles are parsed from the downloaded bytes, not read back from disk
+        start = ttime.monotonic()
+        writer = None
+        if self._container is not None:
+            writer = SRWContainerWriter(self._container_file, len(self._copies))
+        writer_lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            results = list(executor.map(lambda i: self._fetch_datafile(i, writer, writer_lock),
+                                        range(len(self._copies))))
+        if writer is not None:
+            writer.close()
+        self.last_durations['download'] = ttime.monotonic() - start
 
-            ret = read_srw_file(self._srw_files[i])
+        hash_values = []
+        for i, (hash_value, ret) in enumerate(results):
+            hash_values.append(hash_value)
             means.append(ret['mean'])
             shapes.append(ret['shape'])
             photon_energies.append(ret['photon_energy'])
             horizontal_extents.append(ret['horizontal_extent'])
             vertical_extents.append(ret['vertical_extent'])
-            hash_values.append(hashlib.md5(data_file).hexdigest())
-
-            print(f'copy {self._copies[i].sim_id} data hash: {hash_values[i]}')
-            self._copies[i].delete_copy()
+            statistics.append({key: ret[key] for key in BEAM_STATISTICS})
+            if self._record_durations:
+                ret['duration_run'] = self._run_durations[self._copies[i].sim_id]
+                statistics[-1].update({key: ret[key] for key in DURATIONS})
+            print(f'copy {self._copies[i].sim_id} data hash: {hash_value}')
 
-        statuses = []
-        for sim, status in self.return_status.items():
-            statuses.append(status)
+        start = ttime.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            list(executor.map(self._delete_copy, self._copies))
+        self.last_durations['delete'] = ttime.monotonic() - start
 
         assert len(self._copies) == len(self._datum_ids), \
             f'len(self._copies) != len(self._datum_ids) ({len(self._copies)} != {len(self._datum_ids)})'
@@ -282,6 +489,8 @@ class SirepoFlyer(BlueskyFlyer):
                     f'{self.name}_hash_value': hash_values[i],
                     f'{self.name}_status': statuses[i],
                     }
+            for key, value in statistics[i].items():
+                data[f'{self.name}_{key}'] = value
 
             for j in range(len(self.params_to_change)):
                 inputs = self.params_to_change[j]
@@ -298,12 +507,13 @@ class SirepoFlyer(BlueskyFlyer):
                    'timestamps': {key: now for key in data}, 'time': now,
                    'filled': {key: False for key in data}}
 
-    @staticmethod
-    def _run(sim, return_status):
+    def _run(self, sim):
         print(f'running sim {sim.sim_id}')
         status = sim.run_simulation()
+        elapsed = sim.last_run_stats['elapsed']
+        self.timings.record('run', elapsed)
         print('Status:', status['state'])
-        return_status[sim.sim_id] = status['state']
+        return status['state'], elapsed
 
 
 if __name__ == '__main__':
@@ -1,30 +1,564 @@
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
 import numpy as np
-import srwpy.uti_plot_com as srw_io
+
+SRW_HEADER_LINES = 11
+
+
+def parse_srw_header(lines):
+    """ Returns the ranges (e0, e1, ne, x0, x1, nx, y0, y1, ny), labels and units
+    from the header lines of an SRW ASCII file, as srwpy.uti_plot_com.file_load() does. """
+    ne, nx, ny = [int(lines[i].replace('#', '').split()[0]) for i in [3, 6, 9]]
+    e0, e1, x0, x1, y0, y1 = [float(lines[i].replace('#', '').split()[0]) for i in [1, 2, 4, 5, 7, 8]]
+    ranges = e0, e1, ne, x0, x1, nx, y0, y1, ny
+
+    labels = ['Photon Energy', 'Horizontal Position', 'Vertical Position', 'Intensity']
+    units = ['eV', 'm', 'm', 'ph/s/.1%bw/mm^2']
+    tokens = lines[0].split(' [')
+    labels[3] = tokens[0].replace('#', '')
+    units[3] = ''
+    if len(tokens) > 1:
+        units[3] = tokens[1].split('] ')[0]
+    for i in range(3):
+        tokens = lines[i * 3 + 1].split()
+        labels[i] = ' '.join(tokens[2:-1])
+        units[i] = tokens[-1].replace('[', '').replace(']', '')
+    return ranges, labels, units
+
+
+BEAM_STATISTICS = ('peak', 'flux', 'centroid_x', 'centroid_y', 'rms_x', 'rms_y', 'fwhm_x', 'fwhm_y')
+
+
+def _fwhm(x, profile):
+    """ Returns the full width at half maximum of profile, interpolated between the points x. """
+    half = profile.max() / 2
+    above = np.flatnonzero(profile >= half)
+    if half <= 0 or above.size == 0:
+        return 0.
+    i0, i1 = above[0], above[-1]
+    left, right = x[i0], x[i1]
+    if i0 > 0:
+        left = np.interp(half, profile[i0 - 1:i0 + 1], x[i0 - 1:i0 + 1])
+    if i1 < len(x) - 1:
+        # np.interp needs increasing sample points
+        right = np.interp(half, profile[i1:i1 + 2][::-1], x[i1:i1 + 2][::-1])
+    return float(right - left)
+
+
+def _axis(extent, n):
+    return np.linspace(extent[0], extent[1], n)
+
+
+# in meters
+LENGTH_UNITS = {'m': 1., 'cm': 1e-2, 'mm': 1e-3, 'um': 1e-6, 'µm': 1e-6, 'nm': 1e-9}
+
+
+def _area_scale(units):
+    """ Returns the factor converting a pixel area in the units of the axes to the area
+    unit of the intensity, e.g. 1e6 from m^2 to mm^2 for ph/s/.1%bw/mm^2, or 1 if unknown. """
+    axes = [LENGTH_UNITS.get(unit) for unit in units[1:3]]
+    for name, size in LENGTH_UNITS.items():
+        if units[3].endswith('/{}^2'.format(name)) and None not in axes:
+            return axes[0] * axes[1] / size ** 2
+    return 1.
+
+
+def beam_statistics(data, horizontal_extent, vertical_extent=None, units=None):
+    """
+    Computes the beam statistics of an SRW image or spectrum from its projections.
+
+    The coordinates are in the units of the extents. The flux is the sum of
+    the intensity times the pixel area (length for a spectrum), converted to
+    the area unit of the intensity if units are given, e.g. from m^2 to mm^2.
+    The mean of the data is derived from the same sums.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image of shape (ny, nx), or 1-D spectrum
+    horizontal_extent : tuple
+        (start, end) of the horizontal axis, or of the axis of a spectrum
+    vertical_extent : tuple, optional
+        (start, end) of the vertical axis of an image
+    units : sequence of str, optional
+        Units of the photon energy, horizontal and vertical positions and
+        intensity of an image, as returned by read_srw_file()
+
+    Returns
+    -------
+    dict with the BEAM_STATISTICS keys and 'mean', the vertical ones are NaN for a spectrum
+
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        profiles = [(_axis(horizontal_extent, data.size), data)]
+    else:
+        ny, nx = data.shape
+        profiles = [(_axis(horizontal_extent, nx), data.sum(axis=0)),
+                    (_axis(vertical_extent, ny), data.sum(axis=1))]
+    # the total and the mean come from a projection, not from another pass over the image
+    total = float(profiles[0][1].sum())
+    pixel = 1.
+    ret = {'peak': float(data.max()) if data.size else 0.,
+           'mean': total / data.size if data.size else float('nan')}
+    for name, (x, profile) in zip('xy', profiles):
+        if x.size > 1:
+            pixel *= abs(x[1] - x[0])
+        if total != 0:
+            centroid = float(np.dot(x, profile) / total)
+            rms = float(np.sqrt(max(np.dot((x - centroid) ** 2, profile) / total, 0.)))
+        else:
+            centroid = rms = 0.
+        ret['centroid_' + name] = centroid
+        ret['rms_' + name] = rms
+        ret['fwhm_' + name] = _fwhm(x, profile)
+    for name in 'xy'[len(profiles):]:
+        ret['centroid_' + name] = ret['rms_' + name] = ret['fwhm_' + name] = float('nan')
+    if data.ndim == 2 and units is not None:
+        pixel *= _area_scale(units)
+    ret['flux'] = total * pixel
+    return ret
 
 
 def read_srw_file(filename, ndim=2):
-    data, mode, ranges, labels, units = srw_io.file_load(filename)
-    data = np.array(data)
+    """
+    Reads an SRW ASCII file.
+
+    Parameters
+    ----------
+    filename : str, Path, bytes or file-like object
+        Path of the file, its content, or an open (text or binary) file
+    ndim : int, optional
+        2 for an image, 1 for a spectrum
+
+    """
+    if isinstance(filename, (bytes, bytearray, memoryview)):
+        f = io.StringIO(bytes(filename).decode())
+    elif isinstance(filename, (io.RawIOBase, io.BufferedIOBase)):
+        f = io.StringIO(filename.read().decode())
+    elif hasattr(filename, 'read'):
+        f = filename
+    else:
+        with open(filename, 'r') as f:
+            return read_srw_file(f, ndim=ndim)
+    header = [f.readline() for _ in range(SRW_HEADER_LINES)]
+    body = f.read()
+    if not header[-1].startswith('#'):
+        # the header has only 10 lines
+        body = header.pop() + body
+    # the intensity is the first column
+    data = np.loadtxt(io.StringIO(body), dtype=np.float64, comments='#', usecols=0, ndmin=1)
+    ranges, labels, units = parse_srw_header(header)
     if ndim == 2:
         data = data.reshape((ranges[8], ranges[5]), order='C')
-    return {'data': data,
-            'shape': data.shape,
-            'mean': np.mean(data),
-            'photon_energy': ranges[0],
-            'horizontal_extent': ranges[3:5],
-            'vertical_extent': ranges[6:8],
-            # 'mode': mode,
-            'labels': labels,
-            'units': units}
+        statistics = beam_statistics(data, ranges[3:5], ranges[6:8], units=units)
+    else:
+        # spectrum vs photon energy
+        statistics = beam_statistics(data, ranges[0:2])
+    ret = {'data': data,
+           'shape': data.shape,
+           'photon_energy': ranges[0],
+           'horizontal_extent': ranges[3:5],
+           'vertical_extent': ranges[6:8],
+           # 'mode': mode,
+           'labels': labels,
+           'units': units}
+    ret.update(statistics)
+    return ret
+
+
+def _pixel_slices(bounds):
+    """ Returns the slices of the (start, stop) pairs of bounds, one pair per axis. """
+    return tuple(slice(bounds[i], bounds[i + 1]) for i in range(0, len(bounds), 2))
+
+
+class ImageTransform(object):
+    """
+    Crops, bins and casts the images of an SRW file at ingest.
+
+    The transform is recorded in the resource kwargs (see resource_kwargs()).
+    The detector and the flyer store the transformed images as .npy files,
+    SRWFileHandler applies it again when it reads an SRW file.
+
+    Parameters
+    ----------
+    dtype : str or np.dtype, optional
+        Type of the stored pixels, e.g. 'float32'. Defaults to float64.
+    binning : int or sequence of int, optional
+        Number of pixels averaged in each bin along each axis, e.g. (2, 2)
+        for an image. The trailing pixels which don't fill a bin are dropped.
+    roi : sequence of int, optional
+        Region of interest in pixels of the full image, cropped before the
+        binning: (first row, last row + 1, first column, last column + 1)
+        for an image, (first point, last point + 1) for a spectrum.
+
+    """
+
+    def __init__(self, dtype=None, binning=None, roi=None):
+        self.dtype = None if dtype is None else np.dtype(dtype).name
+        self.binning = None if binning is None else tuple(int(b) for b in np.atleast_1d(binning))
+        self.roi = None if roi is None else tuple(int(r) for r in roi)
+        if self.binning is not None and min(self.binning) < 1:
+            raise ValueError(f'invalid binning: {binning}. Must be at least 1')
+        if self.roi is not None and (len(self.roi) % 2 or min(self.roi) < 0 or
+                                     any(self.roi[i] >= self.roi[i + 1] for i in range(0, len(self.roi), 2))):
+            raise ValueError(f'invalid roi: {roi}. Must be (start, stop) pairs with 0 <= start < stop')
+
+    def __repr__(self):
+        return 'ImageTransform(dtype={!r}, binning={!r}, roi={!r})'.format(self.dtype, self.binning, self.roi)
+
+    @property
+    def is_identity(self):
+        return self.dtype is None and self.binning is None and self.roi is None
+
+    def resource_kwargs(self):
+        """ Returns the kwargs recording the transform in a resource document. """
+        kwargs = {}
+        if self.dtype is not None:
+            kwargs['dtype'] = self.dtype
+        if self.binning is not None:
+            kwargs['binning'] = list(self.binning)
+        if self.roi is not None:
+            kwargs['roi'] = list(self.roi)
+        return kwargs
+
+    @property
+    def suffix(self):
+        """ Identifies the transform in file names, '' for the identity. """
+        parts = []
+        if self.dtype is not None:
+            parts.append(self.dtype)
+        if self.binning is not None:
+            parts.append('b' + 'x'.join(map(str, self.binning)))
+        if self.roi is not None:
+            parts.append('r' + '-'.join(map(str, self.roi)))
+        return ''.join('.' + part for part in parts)
+
+    def transformed_shape(self, shape):
+        """ Returns the shape of the transformed array given the shape of the full array.
+        Raises ValueError if the roi or the binning don't fit in it. """
+        shape = tuple(shape)
+        if self.roi is not None:
+            if len(self.roi) != 2 * len(shape):
+                raise ValueError(f'roi {self.roi} does not match an array of {len(shape)} dimensions')
+            if any(self.roi[2 * i + 1] > n for i, n in enumerate(shape)):
+                raise ValueError(f'roi {self.roi} is outside of an array of shape {shape}')
+            shape = tuple(self.roi[2 * i + 1] - self.roi[2 * i] for i in range(len(shape)))
+        if self.binning is not None:
+            binning = self._binning(len(shape))
+            if any(b > n for n, b in zip(shape, binning)):
+                raise ValueError(f'binning {self.binning} is larger than an array of shape {shape}')
+            shape = tuple(n // b for n, b in zip(shape, binning))
+        return shape
+
+    def _binning(self, ndim):
+        binning = self.binning * ndim if len(self.binning) == 1 else self.binning
+        if len(binning) != ndim:
+            raise ValueError(f'binning {self.binning} does not match an array of {ndim} dimensions')
+        return binning
+
+    def __call__(self, data):
+        # validates the roi and the binning
+        self.transformed_shape(data.shape)
+        if self.roi is not None:
+            data = data[_pixel_slices(self.roi)]
+        if self.binning is not None:
+            binning = self._binning(data.ndim)
+            data = data[tuple(slice(0, n - n % b) for n, b in zip(data.shape, binning))]
+            shape = sum(((n // b, b) for n, b in zip(data.shape, binning)), ())
+            data = data.reshape(shape).mean(axis=tuple(range(1, 2 * data.ndim, 2)))
+        if self.dtype is not None:
+            data = data.astype(self.dtype, copy=False)
+        return data
+
+    def extents(self, horizontal_extent, vertical_extent, shape):
+        """ Returns the horizontal and vertical extents of the transformed image
+        given the extents and the shape (ny, nx) of the full image. """
+        count_y, count_x = self.transformed_shape(shape)
+        ret = []
+        for axis, (extent, n, count) in enumerate(((horizontal_extent, shape[1], count_x),
+                                                   (vertical_extent, shape[0], count_y))):
+            step = (extent[1] - extent[0]) / (n - 1) if n > 1 else 0.
+            start = 0 if self.roi is None else self.roi[2 * (1 - axis)]
+            b = 1 if self.binning is None else self._binning(2)[1 - axis]
+            # coordinates of the centers of the first and last bins
+            first = extent[0] + (start + (b - 1) / 2) * step
+            ret.append((first, first + (count - 1) * b * step))
+        return tuple(ret)
+
+
+def sidecar_path(filename, ndim=2, transform=None):
+    """ Returns the path of the binary sidecar of an SRW file. """
+    suffix = '' if transform is None else transform.suffix
+    return '{}.{}d{}.npy'.format(filename, ndim, suffix)
+
+
+def read_srw_data(filename, ndim=2, transform=None):
+    """
+    Returns the data of an SRW file, memory-mapped from its binary sidecar.
+
+    The sidecar is written next to the file the first time it is decoded.
+    It is stamped with the modification time of the file and decoded again
+    if the file changes. If the sidecar can't be written, the decoded array
+    is returned. If an ImageTransform is given, the sidecar holds the
+    transformed data.
+
+    A .npy file holds an image stored by the detector or the flyer, already
+    transformed, and is memory-mapped as is.
+    """
+    if str(filename).endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    path = sidecar_path(filename, ndim, transform)
+    mtime_ns = os.stat(filename).st_mtime_ns
+    try:
+        if os.stat(path).st_mtime_ns == mtime_ns:
+            return np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    data = read_srw_file(filename, ndim=ndim)['data']
+    if transform is not None:
+        data = transform(data)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.npy')
+    except OSError:
+        return data
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+        os.utime(tmp, ns=(mtime_ns, mtime_ns))
+        os.replace(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        return data
+    return np.load(path, mmap_mode='r')
+
+
+class ArrayCache(object):
+    """
+    Thread-safe LRU cache of read-only arrays, bounded by their total size in bytes.
+
+    Parameters
+    ----------
+    max_bytes: int, optional
+        Maximum total size of the cached arrays, 0 disables the cache.
+        Defaults is 512 MiB.
+
+    """
+
+    def __init__(self, max_bytes=512 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._arrays = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ArrayCache(max_bytes={}, bytes={}, entries={})'.format(
+            self.max_bytes, self._bytes, len(self._arrays))
+
+    def get(self, key):
+        """ Returns the array stored for key, or None. """
+        with self._lock:
+            array = self._arrays.get(key)
+            if array is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._arrays.move_to_end(key)
+            return array
+
+    def put(self, key, array):
+        """ Stores array for key, evicting the least recently used arrays if needed.
+        Memory-mapped arrays are not stored, their pages are not held in memory. """
+        if isinstance(array, np.memmap) or array.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._arrays.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._arrays[key] = array
+            self._bytes += array.nbytes
+            self._evict()
+
+    def resize(self, max_bytes):
+        """ Changes the maximum total size of the cached arrays, 0 disables the cache. """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """ Returns the number of hits, misses, evictions, cached arrays and cached bytes. """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._arrays),
+                    'bytes': self._bytes,
+                    'max_bytes': self.max_bytes}
+
+    def _evict(self):
+        while self._bytes > self.max_bytes:
+            _, array = self._arrays.popitem(last=False)
+            self._bytes -= array.nbytes
+            self.evictions += 1
 
 
 class SRWFileHandler:
+    """
+    Databroker handler of SRW files.
+
+    Set use_sidecar to False (e.g. in re_config.py) to always parse the ASCII
+    file instead of memory-mapping its binary sidecar.
+
+    The decoded arrays are kept in cache, an ArrayCache shared by all the
+    handlers of the process and keyed by (filename, ndim, transform, mtime).
+    The memory-mapped sidecars are not cached, the page cache of the OS
+    already keeps them, so the cache only applies with use_sidecar = False. The arrays are read-only. Use SRWFileHandler.cache.resize() to size the
+    cache (0 disables it) and SRWFileHandler.cache.stats() to inspect it.
+
+    The dtype, binning and roi resource kwargs written by the detector and
+    the flyer are applied as an ImageTransform to the SRW files. With a
+    transform, the detector and the flyer store .npy files which already
+    hold the transformed images, these are read as is.
+
+    Set lazy to True to get dask arrays, in chunks of the given size,
+    backed by the memory-mapped sidecars instead of in-memory arrays, e.g.
+    to reduce a stack of many images with bounded memory. Calling the
+    handler with a region (first row, last row + 1, first column, last
+    column + 1) of the stored image only reads that region.
+
+    The resource is either one file, or the directory of the files of a run
+    of the detector with one file per datum, given by the filename datum kwarg.
+    """
     specs = {'srw'}
+    use_sidecar = True
+    cache = ArrayCache()
+    lazy = False
+    chunks = 'auto'
 
-    def __init__(self, filename, ndim=2):
+    def __init__(self, filename, ndim=2, dtype=None, binning=None, roi=None):
         self._name = filename
         self._ndim = ndim
+        self._transform = ImageTransform(dtype=dtype, binning=binning, roi=roi)
+
+    def __call__(self, filename=None, region=None):
+        path = self._name if filename is None else os.path.join(self._name, filename)
+        slices = Ellipsis if region is None else _pixel_slices(region)
+        if self.lazy:
+            import dask.array as da
+            data = read_srw_data(path, ndim=self._ndim, transform=self._transform)
+            # name=False skips hashing the whole array to name the dask graph
+            return da.from_array(data, chunks=self.chunks, name=False)[slices]
+        key = (os.path.abspath(path), self._ndim, self._transform.suffix, os.stat(path).st_mtime_ns)
+        data = self.cache.get(key)
+        if data is not None:
+            return data if region is None else data[slices]
+        if region is not None and self.use_sidecar:
+            # only the pages of the region are read, the full array isn't cached
+            data = np.array(read_srw_data(path, ndim=self._ndim, transform=self._transform)[slices])
+            data.flags.writeable = False
+            return data
+        if self.use_sidecar:
+            data = read_srw_data(path, ndim=self._ndim, transform=self._transform)
+        elif str(path).endswith('.npy'):
+            data = np.load(path)
+        else:
+            data = self._transform(read_srw_file(path, ndim=self._ndim)['data'])
+        data.flags.writeable = False
+        self.cache.put(key, data)
+        return data if region is None else data[slices]
+
+    def get_file_list(self, datum_kwargs_gen):
+        # the sidecars are not listed, they are written again on the first read
+        filenames = [datum_kwargs.get('filename') for datum_kwargs in datum_kwargs_gen]
+        if not any(filenames):
+            return [self._name]
+        return [os.path.join(self._name, filename) for filename in filenames]
+
+
+class SRWContainerWriter:
+    """
+    Writes the images of a fly scan as the frames of a single HDF5 dataset.
+
+    Parameters
+    ----------
+    filename : str
+        HDF5 file to create
+    frame_count : int
+        Number of frames of the dataset
+    dataset : str, optional
+        Name of the dataset, 'data' by default
+
+    """
+
+    def __init__(self, filename, frame_count, dataset='data'):
+        import h5py
+        self._file = h5py.File(filename, 'w')
+        self._frame_count = frame_count
+        self._dataset_name = dataset
+        self._dataset = None
+
+    def write(self, frame, data):
+        if self._dataset is None:
+            self._dataset = self._file.create_dataset(self._dataset_name,
+                                                      shape=(self._frame_count,) + data.shape,
+                                                      dtype=data.dtype,
+                                                      chunks=(1,) + data.shape)
+        elif data.shape != self._dataset.shape[1:]:
+            raise ValueError(f'frame {frame} has shape {data.shape}, expected {self._dataset.shape[1:]}')
+        self._dataset[frame] = data
+
+    def close(self):
+        self._file.close()
+
+
+class SRWContainerHandler:
+    """
+    Databroker handler of the HDF5 files written by SRWContainerWriter, one frame per datum.
+
+    As for SRWFileHandler, set lazy to True to get dask arrays and pass a
+    region to only read part of a frame.
+    """
+    specs = {'SIREPO_FLYER_HDF5'}
+    lazy = False
+
+    def __init__(self, filename, dataset='data', **transform):
+        # the frames were transformed before being written, the transform
+        # kwargs are only recorded for provenance
+        self._name = filename
+        self._dataset_name = dataset
+        self._file = None
+
+    def _dataset(self):
+        if self._file is None:
+            import h5py
+            self._file = h5py.File(self._name, 'r')
+        return self._file[self._dataset_name]
+
+    def __call__(self, frame, region=None):
+        slices = () if region is None else _pixel_slices(region)
+        dataset = self._dataset()
+        if self.lazy:
+            import dask.array as da
+            # one chunk per frame, as written
+            return da.from_array(dataset, chunks=dataset.chunks or 'auto', name=False)[(frame,) + slices]
+        return dataset[(frame,) + slices]
+
+    def get_file_list(self, datum_kwargs_gen):
+        return [self._name]
 
-    def __call__(self):
-        d = read_srw_file(self._name, ndim=self._ndim)
-        return d['data']
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,17 @@
+import datetime
+
+import pytest
+
+from local_sirepo_server import LocalSirepoServer
+
+
+@pytest.fixture
+def sirepo_server():
+    with LocalSirepoServer(run_time=0.2, image_shape=(50, 40)) as server:
+        yield server
+
+
+@pytest.fixture
+def root_dir(tmp_path):
+    (tmp_path / datetime.datetime.now().strftime('%Y/%m/%d')).mkdir(parents=True)
+    return str(tmp_path)
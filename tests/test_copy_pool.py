@@ -0,0 +1,63 @@
+import pytest
+
+from copy_pool import SimulationCopyPool
+from local_sirepo_server import BEAMLINE_SIM_ID
+from sirepo_bluesky import SirepoBluesky
+
+
+@pytest.fixture
+def sb(sirepo_server):
+    sb = SirepoBluesky(sirepo_server.url)
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    return sb
+
+
+def test_reset(sb, sirepo_server):
+    with SimulationCopyPool(sb) as pool:
+        c1 = pool.acquire()
+        sim_id = c1.sim_id
+        c1.find_element(c1.data['models']['beamline'], 'title', 'Aperture')['horizontalSize'] = 0.123
+        c1.data['report'] = 'watchpointReport1'
+        pool.release(c1)
+
+        # the same copy comes back with the models of the source and without a report
+        assert pool.acquire() is c1
+        assert c1.sim_id == c1.data['models']['simulation']['simulationId'] == sim_id
+        assert c1.data['models']['beamline'] == sb.data['models']['beamline']
+        assert 'report' not in c1.data
+        assert sirepo_server.requests['copy-simulation'] == 1
+
+
+def test_max_idle(sb, sirepo_server):
+    with SimulationCopyPool(sb, max_idle=1) as pool:
+        copies = [pool.acquire() for _ in range(3)]
+        for c1 in copies:
+            pool.release(c1)
+        # the copies released past max_idle are deleted
+        assert pool.idle_count == 1 and pool.checked_out_count == 0
+        assert sirepo_server.requests['delete-simulation'] == 2
+        assert [c1.sim_id is None for c1 in copies] == [False, True, True]
+
+
+def test_close_deletes_checked_out(sb, sirepo_server):
+    pool = SimulationCopyPool(sb)
+    copies = [pool.acquire() for _ in range(2)]
+    pool.release(copies[0])
+    pool.close()
+    assert pool.idle_count == pool.checked_out_count == 0
+    assert sirepo_server.requests['delete-simulation'] == 2
+    assert all(c1.sim_id is None for c1 in copies)
+
+
+def test_local_edits(sb):
+    # edited locally, the server still has the stored value
+    sb.find_element(sb.data['models']['beamline'], 'title', 'Aperture')['horizontalSize'] = 0.5
+    with SimulationCopyPool(sb) as pool:
+        new = pool.acquire()
+        pool.release(new)
+        new_models = [dict(e) for e in new.data['models']['beamline']]
+        reused = pool.acquire()
+        assert reused is new
+        # a point gets the same inputs whether its copy is new or reused
+        assert new_models == reused.data['models']['beamline'] == sb.data['models']['beamline']
+        assert new.find_element(new_models, 'title', 'Aperture')['horizontalSize'] == 0.5
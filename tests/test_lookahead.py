@@ -0,0 +1,39 @@
+from lookahead import Lookahead
+from local_sirepo_server import BEAMLINE_SIM_ID
+from sirepo_bluesky import SirepoBluesky
+
+
+def _lookahead(sirepo_server, positions, depth=2):
+    sb = SirepoBluesky(sirepo_server.url)
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    watch = sb.find_element(sb.data['models']['beamline'], 'title', 'W60')
+    report = 'watchpointReport{}'.format(watch['id'])
+    return Lookahead(sb, [('Aperture', 'horizontalSize')], [(p,) for p in positions], report, depth=depth), report
+
+
+def test_take_in_order(sirepo_server):
+    lookahead, report = _lookahead(sirepo_server, [0.1, 0.2, 0.3])
+    try:
+        files = [lookahead.take((p,), report).result() for p in (0.1, 0.2, 0.3)]
+        assert len(set(files)) == 3
+        assert lookahead.hits == 3 and lookahead.misses == 0
+    finally:
+        lookahead.close()
+    assert sirepo_server.requests['run-simulation'] == 3
+
+
+def test_take_resyncs(sirepo_server):
+    lookahead, report = _lookahead(sirepo_server, [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8])
+    try:
+        # an off-plan trigger doesn't consume the queue
+        assert lookahead.take((0.15,), report) is None
+        assert lookahead.take((0.1,), report) is not None
+        # skipping a queued point drops it
+        assert lookahead.take((0.3,), report) is not None
+        # a point past the queue drops the queued points and queues the next ones
+        assert lookahead.take((0.7,), report) is None
+        assert [values for values, _ in lookahead._futures] == [(0.8,)]
+        assert lookahead.take((0.8,), report).result()
+        assert lookahead.hits == 3 and lookahead.misses == 2
+    finally:
+        lookahead.close()
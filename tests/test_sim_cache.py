@@ -0,0 +1,45 @@
+import copy
+import os
+import pickle
+
+from sim_cache import SimulationCache, cache_key
+
+DATA = {'models': {'simulation': {'simulationId': 'abc', 'name': 'Bluesky', 'photonEnergy': 1000},
+                   'beamline': [{'title': 'Aperture', 'horizontalSize': 0.1}]},
+        'report': 'watchpointReport1'}
+
+
+def test_cache_key():
+    data = copy.deepcopy(DATA)
+    data['models']['simulation'].update(simulationId='def', name='Bluesky 2')
+    assert cache_key('srw', data) == cache_key('srw', DATA)
+
+    data['models']['beamline'][0]['horizontalSize'] = 0.2
+    assert cache_key('srw', data) != cache_key('srw', DATA)
+
+    data = copy.deepcopy(DATA)
+    data['report'] = 'watchpointReport2'
+    assert cache_key('srw', data) != cache_key('srw', DATA)
+
+
+def test_cache_lru_eviction(tmp_path):
+    cache = SimulationCache(tmp_path, max_bytes=250)
+    for i, key in enumerate('abc'):
+        path = cache.put(key, content=b'x' * 100)
+        os.utime(path, (i, i))
+    # 'a' was evicted to make room for 'c'
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.put('d', content=b'x' * 100)
+    # 'b' was used more recently than 'c'
+    assert cache.path('c') is None
+    assert cache.path('b').read_bytes() == b'x' * 100
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 2, 'entries': 2, 'bytes': 200}
+
+
+def test_cache_pickle(tmp_path):
+    cache = SimulationCache(tmp_path, max_bytes=250)
+    cache.put('a', content=b'x')
+    copied = pickle.loads(pickle.dumps(cache))
+    assert copied.directory == cache.directory and copied.max_bytes == 250
+    assert copied.get('a').read_bytes() == b'x'
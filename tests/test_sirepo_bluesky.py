@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import io
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from async_sirepo_bluesky import AsyncSirepoBluesky
+from local_sirepo_server import BEAMLINE_SIM_ID, LocalSirepoServer
+from sharded_sirepo_bluesky import ShardedSirepoBluesky
+from sim_cache import SimulationCache
+from sirepo_bluesky import PollingPolicy, SirepoBluesky
+
+
+def test_polling_policy_backoff():
+    policy = PollingPolicy(initial=0.1, factor=2, max_interval=1., jitter=0)
+    assert [policy.interval(i) for i in range(6)] == pytest.approx([0.1, 0.2, 0.4, 0.8, 1., 1.])
+
+
+def test_polling_policy_jitter():
+    policy = PollingPolicy(initial=1., jitter=0.2)
+    intervals = [policy.interval(0) for _ in range(100)]
+    assert all(0.8 <= i <= 1.2 for i in intervals)
+    assert len(set(intervals)) > 1
+
+
+def test_polling_policy_timeout():
+    tracker = PollingPolicy(timeout=0).start()
+    with pytest.raises(TimeoutError):
+        tracker.next_delay()
+
+
+def _watchpoint_copy(sb):
+    c1 = sb.copy_sim('Bluesky')
+    watch = c1.find_element(c1.data['models']['beamline'], 'title', 'W60')
+    c1.data['report'] = 'watchpointReport{}'.format(watch['id'])
+    return c1
+
+
+def test_run_simulation(sirepo_server):
+    sb = SirepoBluesky(sirepo_server.url)
+    data, schema = sb.auth('srw', BEAMLINE_SIM_ID)
+    c1 = _watchpoint_copy(sb)
+    assert c1.sim_id != sb.sim_id
+    assert c1.run_simulation()['state'] == 'completed'
+    assert c1.last_run_stats['status_calls'] > 0
+    assert c1.get_datafile().startswith(b'#')
+    c1.delete_copy()
+    assert sirepo_server.requests['delete-simulation'] == 1
+
+
+def test_concurrent_copies(sirepo_server):
+    sb = SirepoBluesky(sirepo_server.url)
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    with ThreadPoolExecutor(8) as executor:
+        copies = list(executor.map(lambda _: sb.copy_sim('Bluesky'), range(16)))
+    assert len({c.data['models']['simulation']['name'] for c in copies}) == 16
+    for c in copies:
+        c.delete_copy()
+
+
+def test_connection_reuse(sirepo_server):
+    sb = SirepoBluesky(sirepo_server.url)
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    c1 = _watchpoint_copy(sb)
+    c1.run_simulation()
+    c1.get_datafile()
+    c1.delete_copy()
+    # the copy shares the session of its parent
+    stats = sb.connection_stats()
+    assert stats == c1.connection_stats()
+    assert stats['requests'] == sum(sirepo_server.requests.values())
+    assert stats['connections_opened'] == 1
+    assert stats['connections_reused'] == stats['requests'] - 1
+
+
+def test_async_client(sirepo_server):
+
+    async def main():
+        async with AsyncSirepoBluesky(sirepo_server.url) as sb:
+            await sb.auth('srw', BEAMLINE_SIM_ID)
+            copies = await asyncio.gather(*[sb.copy_sim('Bluesky') for _ in range(20)])
+            for i, c1 in enumerate(copies):
+                aperture = c1.find_element(c1.data['models']['beamline'], 'title', 'Aperture')
+                aperture['horizontalSize'] = 0.1 * (i + 1)
+                watch = c1.find_element(c1.data['models']['beamline'], 'title', 'W60')
+                c1.data['report'] = 'watchpointReport{}'.format(watch['id'])
+            await asyncio.gather(*[c1.run_simulation() for c1 in copies])
+            files = await asyncio.gather(*[c1.get_datafile() for c1 in copies])
+            await asyncio.gather(*[c1.delete_copy() for c1 in copies])
+            return files
+
+    start = time.monotonic()
+    files = asyncio.run(main())
+    # the runs overlap
+    assert time.monotonic() - start < 20 * sirepo_server.run_time
+    assert len(set(files)) == 20
+    assert sirepo_server.requests['delete-simulation'] == 20
+
+
+def test_async_client_cache(sirepo_server, tmp_path):
+    cache = SimulationCache(tmp_path / 'cache')
+
+    async def run(filename):
+        async with AsyncSirepoBluesky(sirepo_server.url, cache=cache) as sb:
+            await sb.auth('srw', BEAMLINE_SIM_ID)
+            c1 = await sb.copy_sim('Bluesky')
+            watch = c1.find_element(c1.data['models']['beamline'], 'title', 'W60')
+            c1.data['report'] = 'watchpointReport{}'.format(watch['id'])
+            res = await c1.run_simulation()
+            md5 = await c1.download_datafile(filename)
+            await c1.delete_copy()
+            return res, md5, c1.last_run_stats
+
+    res1, md5_1, _ = asyncio.run(run(tmp_path / 'first.dat'))
+    res2, md5_2, stats = asyncio.run(run(tmp_path / 'second.dat'))
+    assert 'cached' not in res1
+    assert res2 == {'state': 'completed', 'cached': True} and stats['cached']
+    assert sirepo_server.requests['run-simulation'] == 1
+    assert md5_1 == md5_2 == hashlib.md5((tmp_path / 'first.dat').read_bytes()).hexdigest()
+
+
+def test_download_datafile(sirepo_server, tmp_path):
+    sb = SirepoBluesky(sirepo_server.url)
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    c1 = _watchpoint_copy(sb)
+    c1.run_simulation()
+    buffer = io.BytesIO()
+    md5 = c1.download_datafile(tmp_path / 'W60.dat', chunk_size=1024, buffer=buffer)
+    content = c1.get_datafile()
+    assert (tmp_path / 'W60.dat').read_bytes() == buffer.getvalue() == content
+    assert md5 == hashlib.md5(content).hexdigest()
+
+
+def test_pickle(sirepo_server):
+    sb = SirepoBluesky(sirepo_server.url)
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    c1 = _watchpoint_copy(sb)
+    c1.run_simulation()
+    # e.g. passed to a spawned process
+    c2 = pickle.loads(pickle.dumps(c1))
+    assert c2.timings.summary()['run-simulation']['count'] == 1
+    c2.run_simulation()
+    assert c2.get_datafile() == c1.get_datafile()
+    assert c1.timings.summary()['run-simulation']['count'] == 1
+
+
+def test_run_simulation_timeout(sirepo_server):
+    sb = SirepoBluesky(sirepo_server.url, polling=PollingPolicy(timeout=0.05))
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    with pytest.raises(TimeoutError):
+        _watchpoint_copy(sb).run_simulation()
+
+
+def test_cached_run(sirepo_server, tmp_path):
+    cache = SimulationCache(tmp_path / 'cache')
+    sb = SirepoBluesky(sirepo_server.url, cache=cache)
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    contents = []
+    for _ in range(2):
+        c1 = _watchpoint_copy(sb)
+        c1.run_simulation()
+        contents.append(c1.get_datafile())
+    assert c1.last_run_stats['cached']
+    assert contents[0] == contents[1]
+    assert sirepo_server.requests['run-simulation'] == 1
+    assert cache.stats()['hits'] == 1
+
+
+def test_cached_run_evicted(sirepo_server, tmp_path):
+    cache = SimulationCache(tmp_path / 'cache')
+    sb = SirepoBluesky(sirepo_server.url, cache=cache)
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    c1 = _watchpoint_copy(sb)
+    c1.run_simulation()
+    expected = c1.get_datafile()
+    c1.run_simulation()
+    assert c1.last_run_stats['cached']
+    # evicted by another client before the datafile is requested
+    cache.clear()
+    assert c1.get_datafile() == expected
+    assert sirepo_server.requests['download-data-file'] == 1
+    assert cache.stats()['entries'] == 0
+
+
+def test_sharded_client(sirepo_server):
+    with LocalSirepoServer(run_time=0.2, image_shape=(50, 40)) as other_server:
+        sb = ShardedSirepoBluesky([sirepo_server.url, other_server.url], max_errors=2, retry_interval=60)
+        sb.auth('srw', BEAMLINE_SIM_ID)
+        copies = [sb.copy_sim('Bluesky') for _ in range(6)]
+        assert {c.server for c in copies} == {sirepo_server.url, other_server.url}
+        assert sirepo_server.requests['copy-simulation'] == other_server.requests['copy-simulation'] == 3
+        for c in copies:
+            c.data['report'] = 'watchpointReport7'
+            c.run_simulation()
+            assert c.get_datafile()
+
+        # runs keep failing on the other server, which gets drained
+        other_server.failure_rate = 1.
+        for c in [c for c in copies if c.server == other_server.url]:
+            with pytest.raises(AssertionError):
+                c.run_simulation()
+        assert sb.stats()[other_server.url]['draining']
+        assert sb.copy_sim('Bluesky').server == sirepo_server.url
+        assert sb.check_health() == {sirepo_server.url: True, other_server.url: True}
+        for c in copies:
+            c.delete_copy()
+        assert sb.stats()[other_server.url]['copies'] == 0
+        # the requests to both servers are timed together
+        assert sb.timings.summary()['copy-simulation']['count'] == 7
+
+
+def test_sharded_client_single_probe(sirepo_server):
+    with LocalSirepoServer() as other_server:
+        sb = ShardedSirepoBluesky([sirepo_server.url, other_server.url], retry_interval=0)
+        sb.auth('srw', BEAMLINE_SIM_ID)
+        sb._drain(sb._shards[1])
+        probe = sb._probe
+        probes = []
+
+        def slow_probe(shard):
+            probes.append(shard)
+            time.sleep(0.2)
+            return probe(shard)
+
+        sb._probe = slow_probe
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: sb._pick(), range(8)))
+        # the other threads don't probe the server being probed
+        assert probes == [sb._shards[1]]
+        assert not sb.stats()[other_server.url]['draining']
@@ -0,0 +1,220 @@
+import os
+import time as ttime
+
+import pytest
+
+from local_sirepo_server import BEAMLINE_SIM_ID
+
+
+class Registry(object):
+    def __init__(self):
+        self.resources = {}
+        self.datums = {}
+
+    def insert_resource(self, spec, resource_path, resource_kwargs):
+        uid = str(len(self.resources))
+        self.resources[uid] = (spec, resource_path, resource_kwargs)
+        return uid
+
+    def insert_datum(self, resource, datum_id, datum_kwargs):
+        self.datums[datum_id] = (resource, datum_kwargs)
+        return datum_id
+
+
+@pytest.fixture
+def detector_factory(sirepo_server, root_dir):
+    import sirepo_detector
+    detectors = []
+
+    def factory(name='sirepo_det', **kwargs):
+        kwargs.setdefault('reg', Registry())
+        det = sirepo_detector.SirepoDetector(name=name, sim_id=BEAMLINE_SIM_ID,
+                                             sirepo_server=sirepo_server.url, **kwargs)
+        det.root_dir = root_dir
+        detectors.append(det)
+        det.select_optic('Aperture')
+        param = det.create_parameter('horizontalSize')
+        return det, param
+
+    yield factory
+    for det in detectors:
+        det.close()
+
+
+def test_trigger_status(detector_factory):
+    det1, param1 = detector_factory('det1')
+    det2, param2 = detector_factory('det2')
+    param1.set(0.3)
+    param2.set(0.6)
+    start = ttime.monotonic()
+    det1.trigger().wait(timeout=10)
+    single = ttime.monotonic() - start
+
+    param1.set(0.4)
+    start = ttime.monotonic()
+    statuses = [det1.trigger(), det2.trigger()]
+    assert not any(status.done for status in statuses)
+    for status in statuses:
+        status.wait(timeout=10)
+    # both simulations ran at the same time
+    assert ttime.monotonic() - start < 1.5 * single
+    assert all(status.success for status in statuses)
+    assert det1.image.get() in det1.reg.datums
+    assert det2.image.get() in det2.reg.datums
+
+
+def test_trigger_failure(detector_factory, sirepo_server):
+    det, param = detector_factory()
+    sirepo_server.failure_rate = 1.
+    status = det.trigger()
+    with pytest.raises(Exception):
+        status.wait(timeout=10)
+    assert not status.success
+
+
+def test_trigger_write_failure(detector_factory, tmp_path):
+    det, param = detector_factory(reg=None)
+    det.root_dir = str(tmp_path / 'missing')
+    status = det.trigger()
+    with pytest.raises(Exception):
+        status.wait(timeout=10)
+    assert not status.success
+    # no datum refers to the missing file
+    assert list(det.collect_asset_docs()) == []
+
+
+def test_trigger_skips_unchanged(detector_factory, sirepo_server):
+    det, param = detector_factory()
+    param.set(0.3)
+    det.trigger().wait(timeout=10)
+    image = det.image.get()
+    assert sirepo_server.requests['run-simulation'] == 1
+
+    # nothing changed, the simulation isn't run again
+    status = det.trigger()
+    assert status.done and status.success
+    assert det.image.get() == image
+    assert sirepo_server.requests['run-simulation'] == 1
+
+    param.set(0.6)
+    det.trigger().wait(timeout=10)
+    assert det.sb.data['models']['beamline'][det._optic_ids['Aperture']]['horizontalSize'] == 0.6
+    assert sirepo_server.requests['run-simulation'] == 2
+
+    det.invalidate()
+    det.trigger().wait(timeout=10)
+    assert sirepo_server.requests['run-simulation'] == 3
+
+
+def test_components_created_on_demand(detector_factory):
+    det, param = detector_factory()
+    # only the selected optic has a component, all the optics are listed
+    assert list(det.sirepo_components) == ['Aperture']
+    assert set(det.optic_parameters) == {e['title'] for e in det.data['models']['beamline']}
+    det.select_optic('Lens')
+    assert det.sirepo_component.sirepo_horizontalFocalLength.position == \
+        det.optic_parameters['Lens']['sirepo_horizontalFocalLength']
+    det.select_optic('Aperture')
+    assert det.sirepo_component is det.sirepo_components['Aperture']
+
+
+def test_prefetch(detector_factory, sirepo_server):
+    import bluesky.plans as bp
+    from bluesky import RunEngine
+    det, param = detector_factory()
+    det.prefetch_plan(bp.scan([det], param, 0.1, 0.5, 5), depth=3)
+    lookahead = det._lookahead
+    means = []
+    RE = RunEngine({})
+    RE(bp.scan([det], param, 0.1, 0.5, 5), lambda name, doc: means.append(doc['data']['sirepo_det_rms_x'])
+       if name == 'event' else None)
+    assert lookahead.hits == 5 and lookahead.misses == 0
+    # all the points ran on the copies, which were deleted by unstage()
+    assert sirepo_server.requests['run-simulation'] == 5
+    assert sirepo_server.requests['copy-simulation'] == sirepo_server.requests['delete-simulation'] <= 3
+    assert det._lookahead is None
+    assert means == sorted(means)
+
+
+def test_prefetch_local_edits(detector_factory, sirepo_server):
+    det, param = detector_factory()
+    # edited locally, the server still has the stored value
+    det._element('Lens')['horizontalFocalLength'] = 0.5
+    det.invalidate()
+    param.set(0.3)
+    det.trigger().wait(timeout=10)
+    expected = det.rms_x.get()
+
+    det.prefetch([0.3], depth=1)
+    det.invalidate()
+    det.trigger().wait(timeout=10)
+    assert det._lookahead.hits == 1
+    # the point run ahead on a copy has the same inputs as the direct run
+    assert det.rms_x.get() == expected
+    det.cancel_prefetch()
+
+
+def test_trigger_durations(detector_factory):
+    det, param = detector_factory()
+    param.set(0.3)
+    det.trigger().wait(timeout=10)
+    det.flush()
+    assert det.duration_total.get() >= det.duration_run.get() > 0
+    assert set(det.timings.summary()) == {'run', 'download', 'read', 'register', 'total', 'write'}
+    assert {'bluesky-auth', 'run-simulation', 'run-status', 'download-data-file', 'simulation'} <= \
+        set(det.sb.timings.summary())
+    assert det.duration_run.name not in det.read()
+    det.read_attrs = det.read_attrs + ['duration_run']
+    assert det.read()[det.duration_run.name]['value'] == det.duration_run.get()
+
+
+@pytest.mark.parametrize('resource_per_stage', [False, True])
+def test_asset_docs(detector_factory, resource_per_stage):
+    import bluesky.plans as bp
+    from bluesky import RunEngine
+    from srw_handler import SRWFileHandler
+    det, param = detector_factory(reg=None, resource_per_stage=resource_per_stage)
+    docs = []
+    RE = RunEngine({})
+    RE(bp.scan([det], param, 0.1, 0.5, 3), lambda name, doc: docs.append((name, doc)))
+    resources = {doc['uid']: doc for name, doc in docs if name == 'resource'}
+    datums = {doc['datum_id']: doc for name, doc in docs if name == 'datum'}
+    events = [doc for name, doc in docs if name == 'event']
+    assert len(resources) == (1 if resource_per_stage else 3)
+    assert len(datums) == len(events) == 3
+    for event in events:
+        datum = datums[event['data'][det.image.name]]
+        resource = resources[datum['resource']]
+        handler = SRWFileHandler(os.path.join(resource['root'], resource['resource_path']),
+                                 **resource['resource_kwargs'])
+        image = handler(**datum['datum_kwargs'])
+        assert image.mean() == pytest.approx(event['data'][det.mean.name])
+
+
+def test_stage_without_trigger(detector_factory):
+    det, param = detector_factory(reg=None, resource_per_stage=True)
+    det.stage()
+    det.unstage()
+    assert list(det.collect_asset_docs()) == []
+    det.stage()
+    det.trigger().wait(timeout=10)
+    names = [name for name, doc in det.collect_asset_docs()]
+    det.unstage()
+    assert names == ['resource', 'datum']
+
+def test_asset_docs_transform(detector_factory):
+    import bluesky.plans as bp
+    import numpy as np
+    from bluesky import RunEngine
+    from srw_handler import SRWFileHandler
+    det, param = detector_factory(reg=None, dtype='float32', binning=2, roi=(0, 40, 10, 50))
+    docs = []
+    RunEngine({})(bp.count([det]), lambda name, doc: docs.append((name, doc)))
+    resource = [doc for name, doc in docs if name == 'resource'][0]
+    event = [doc for name, doc in docs if name == 'event'][0]
+    # only the transformed image is stored
+    assert resource['resource_path'].endswith('.npy')
+    image = SRWFileHandler(os.path.join(resource['root'], resource['resource_path']),
+                           **resource['resource_kwargs'])()
+    assert image.dtype == np.float32
+    assert image.shape == tuple(event['data'][det.shape.name]) == (20, 20)
@@ -1,3 +1,4 @@
+import pytest
 import vcr
 
 from sirepo_bluesky import SirepoBluesky
@@ -31,3 +32,170 @@ def test_sirepo_flyer():
                                watch_name='W60', run_parallel=False)
 
     RE(bp.fly([sirepo_flyer]))
+
+
+def _fly(flyer):
+    from bluesky import RunEngine
+    import bluesky.plans as bp
+    docs = []
+    RunEngine({})(bp.fly([flyer]), lambda name, doc: docs.append((name, doc)))
+    return docs
+
+
+def _events(docs):
+    import event_model
+    events = [doc for name, doc in docs if name == 'event']
+    for name, doc in docs:
+        if name == 'event_page':
+            events.extend(event_model.unpack_event_page(doc))
+    return events
+
+
+def test_sirepo_flyer_timings(sirepo_server, root_dir):
+    from local_sirepo_server import BEAMLINE_SIM_ID
+    from sirepo_flyer import SirepoFlyer
+    params_to_change = [{'Aperture': {'horizontalSize': i * .1}} for i in range(1, 4 + 1)]
+
+    sirepo_flyer = SirepoFlyer(sim_id=BEAMLINE_SIM_ID, server_name=sirepo_server.url,
+                               root_dir=root_dir, params_to_change=params_to_change,
+                               watch_name='W60', run_parallel=False, max_concurrency=2)
+    events = _events(_fly(sirepo_flyer))
+    assert len(events) == 4
+    assert set(sirepo_flyer.last_durations) == {'copy', 'run', 'download', 'delete'}
+    # the serial runs dominate, the other phases are spread over the threads
+    assert sirepo_flyer.last_durations['run'] >= 4 * sirepo_server.run_time
+    assert sirepo_server.requests['copy-simulation'] == sirepo_server.requests['delete-simulation'] == 4
+    assert sirepo_server.requests['download-data-file'] == 4
+
+
+def test_sirepo_flyer_copy_pool(sirepo_server, root_dir):
+    from copy_pool import SimulationCopyPool
+    from local_sirepo_server import BEAMLINE_SIM_ID
+    from sirepo_flyer import SirepoFlyer
+    params_to_change = [{'Aperture': {'horizontalSize': i * .1}} for i in range(1, 5 + 1)]
+
+    sb = SirepoBluesky(sirepo_server.url)
+    sb.auth('srw', BEAMLINE_SIM_ID)
+    with SimulationCopyPool(sb, max_idle=5) as pool:
+        sirepo_flyer = SirepoFlyer(sim_id=BEAMLINE_SIM_ID, server_name=sirepo_server.url,
+                                   root_dir=root_dir, params_to_change=params_to_change,
+                                   watch_name='W60', run_parallel=False, copy_pool=pool)
+        for _ in range(2):
+            events = _events(_fly(sirepo_flyer))
+            assert [e['data']['sirepo_flyer_status'] for e in events] == ['completed'] * 5
+            assert pool.idle_count == 5
+    # the copies were created once and deleted when the pool was closed
+    assert sirepo_server.requests['copy-simulation'] == 5
+    assert sirepo_server.requests['delete-simulation'] == 5
+
+
+def test_sirepo_flyer_container(sirepo_server, root_dir):
+    import os
+    import numpy as np
+    from local_sirepo_server import BEAMLINE_SIM_ID
+    from sirepo_flyer import SirepoFlyer
+    from srw_handler import SRWContainerHandler
+    params_to_change = [{'Aperture': {'horizontalSize': i * .1}} for i in range(1, 5 + 1)]
+
+    sirepo_flyer = SirepoFlyer(sim_id=BEAMLINE_SIM_ID, server_name=sirepo_server.url,
+                               root_dir=root_dir, params_to_change=params_to_change,
+                               watch_name='W60', run_parallel=False, container='hdf5')
+    docs = _fly(sirepo_flyer)
+    resources = [doc for name, doc in docs if name == 'resource']
+    datums = [doc for name, doc in docs if name == 'datum']
+    assert len(resources) == 1
+    assert [d['datum_kwargs'] for d in datums] == [{'frame': i} for i in range(5)]
+    # only the container is left on disk
+    assert os.listdir(os.path.dirname(resources[0]['resource_path'])) == \
+        [os.path.basename(resources[0]['resource_path'])]
+
+    handler = SRWContainerHandler(resources[0]['resource_path'], **resources[0]['resource_kwargs'])
+    events = _events(docs)
+    for event, datum in zip(events, datums):
+        frame = handler(**datum['datum_kwargs'])
+        assert frame.shape == tuple(event['data']['sirepo_flyer_shape'])
+        assert np.mean(frame) == pytest.approx(event['data']['sirepo_flyer_mean'])
+        assert np.max(frame) == event['data']['sirepo_flyer_peak']
+    handler.close()
+
+
+def test_sirepo_flyer_transform(sirepo_server, root_dir):
+    import numpy as np
+    from local_sirepo_server import BEAMLINE_SIM_ID
+    from sirepo_flyer import SirepoFlyer
+    from srw_handler import SRWFileHandler
+    params_to_change = [{'Aperture': {'horizontalSize': i * .1}} for i in range(1, 3 + 1)]
+
+    sirepo_flyer = SirepoFlyer(sim_id=BEAMLINE_SIM_ID, server_name=sirepo_server.url,
+                               root_dir=root_dir, params_to_change=params_to_change,
+                               watch_name='W60', run_parallel=False, dtype='float32', binning=2,
+                               record_durations=True)
+    docs = _fly(sirepo_flyer)
+    resources = [doc for name, doc in docs if name == 'resource']
+    assert resources[0]['resource_kwargs'] == {'dtype': 'float32', 'binning': [2]}
+    for event, resource in zip(_events(docs), resources):
+        # only the transformed image is stored
+        assert resource['resource_path'].endswith('.npy')
+        frame = SRWFileHandler(resource['resource_path'], **resource['resource_kwargs'])()
+        assert frame.dtype == np.float32
+        # the server serves 50x40 images
+        assert frame.shape == tuple(event['data']['sirepo_flyer_shape']) == (20, 25)
+        assert event['data']['sirepo_flyer_duration_run'] > 0
+    assert sirepo_flyer.timings.summary()['download']['count'] == 3
+
+
+def test_sirepo_flyer_servers(sirepo_server, root_dir):
+    from local_sirepo_server import BEAMLINE_SIM_ID, LocalSirepoServer
+    from sirepo_flyer import SirepoFlyer
+    params_to_change = [{'Aperture': {'horizontalSize': i * .1}} for i in range(1, 4 + 1)]
+
+    with LocalSirepoServer(run_time=0.2, image_shape=(50, 40)) as other_server:
+        sirepo_flyer = SirepoFlyer(sim_id=BEAMLINE_SIM_ID, server_name=[sirepo_server.url, other_server.url],
+                                   root_dir=root_dir, params_to_change=params_to_change,
+                                   watch_name='W60', run_parallel=False)
+        events = _events(_fly(sirepo_flyer))
+        assert [e['data']['sirepo_flyer_status'] for e in events] == ['completed'] * 4
+        assert sirepo_server.requests['run-simulation'] == other_server.requests['run-simulation'] == 2
+
+
+def test_sirepo_flyer_max_workers(sirepo_server, root_dir):
+    from local_sirepo_server import BEAMLINE_SIM_ID
+    from sirepo_flyer import SirepoFlyer
+    params_to_change = [{'Aperture': {'horizontalSize': i * .1}} for i in range(1, 6 + 1)]
+
+    sirepo_flyer = SirepoFlyer(sim_id=BEAMLINE_SIM_ID, server_name=sirepo_server.url,
+                               root_dir=root_dir, params_to_change=params_to_change,
+                               watch_name='W60', run_parallel=True, max_workers=2, record_durations=True)
+    events = _events(_fly(sirepo_flyer))
+    assert [e['data']['sirepo_flyer_status'] for e in events] == ['completed'] * 6
+    assert all(e['data']['sirepo_flyer_duration_run'] > 0 for e in events)
+    # 6 runs of 0.2 s, 2 at a time
+    assert sirepo_flyer.last_durations['run'] >= 3 * 0.2
+    executor = sirepo_flyer._run_executor
+    _fly(sirepo_flyer)
+    assert sirepo_flyer._run_executor is executor
+    assert sirepo_server.requests['run-simulation'] == 12
+    sirepo_flyer.close()
+    assert sirepo_flyer._run_executor is None
+
+
+
+def test_sirepo_flyer_pool_size(sirepo_server, root_dir):
+    from local_sirepo_server import BEAMLINE_SIM_ID
+    from sirepo_flyer import SirepoFlyer
+    params_to_change = [{'Aperture': {'horizontalSize': i * .01}} for i in range(1, 20 + 1)]
+
+    sirepo_flyer = SirepoFlyer(sim_id=BEAMLINE_SIM_ID, server_name=sirepo_server.url,
+                               root_dir=root_dir, params_to_change=params_to_change,
+                               watch_name='W60', run_parallel=True, max_workers=20, max_concurrency=20)
+    _fly(sirepo_flyer)
+    sirepo_flyer.close()
+    # the session keeps a connection per thread instead of discarding them
+    assert sirepo_flyer._copies[0].connection_stats()['connections_opened'] <= 20
+
+@pytest.mark.parametrize('kwargs', [{'max_workers': 0}, {'max_concurrency': 0}])
+def test_sirepo_flyer_invalid_workers(root_dir, kwargs):
+    from sirepo_flyer import SirepoFlyer
+    with pytest.raises(ValueError):
+        SirepoFlyer(sim_id='abc', server_name='http://localhost:8000', root_dir=root_dir,
+                    params_to_change=[], **kwargs)
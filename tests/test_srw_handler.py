@@ -0,0 +1,192 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from local_sirepo_server import srw_file_content
+from srw_handler import (ArrayCache, ImageTransform, SRWContainerHandler, SRWContainerWriter, SRWFileHandler,
+                         beam_statistics, read_srw_file, sidecar_path)
+
+
+@pytest.fixture
+def srw_file(tmp_path):
+    x = np.linspace(-1, 1, 30)
+    y = np.linspace(-1, 1, 20)
+    values = np.exp(-np.add.outer(y ** 2, x ** 2)) * 1e13
+    filename = tmp_path / 'image.dat'
+    filename.write_bytes(srw_file_content((4240., 4240., 1, -1e-3, 1e-3, 30, -2e-3, 2e-3, 20), values))
+    return str(filename), values
+
+
+def test_read_srw_file_matches_srwpy(srw_file):
+    srw_io = pytest.importorskip('srwpy.uti_plot_com')
+    filename, values = srw_file
+    data, mode, ranges, labels, units = srw_io.file_load(filename)
+    ret = read_srw_file(filename)
+    assert ret['shape'] == (20, 30)
+    np.testing.assert_array_equal(ret['data'], np.array(data).reshape((20, 30)))
+    np.testing.assert_allclose(ret['data'], values, rtol=1e-6)
+    assert ret['photon_energy'] == ranges[0]
+    assert ret['horizontal_extent'] == tuple(ranges[3:5])
+    assert ret['vertical_extent'] == tuple(ranges[6:8])
+    assert ret['labels'] == labels
+    assert ret['units'] == units
+
+
+def test_read_srw_file_in_memory(srw_file):
+    filename, values = srw_file
+    expected = read_srw_file(filename)
+    with open(filename, 'rb') as f:
+        content = f.read()
+    for source in (content, io.BytesIO(content), io.StringIO(content.decode())):
+        ret = read_srw_file(source)
+        np.testing.assert_array_equal(ret['data'], expected['data'])
+        assert ret['horizontal_extent'] == expected['horizontal_extent']
+        assert ret['units'] == expected['units']
+
+
+def test_beam_statistics():
+    x = np.linspace(-1e-3, 1e-3, 401)
+    y = np.linspace(-2e-3, 2e-3, 301)
+    sx, sy = 1e-4, 2e-4
+    data = 5. * np.exp(-0.5 * (((x - 2e-4) / sx) ** 2 + ((y[:, np.newaxis] + 1e-4) / sy) ** 2))
+    ret = beam_statistics(data, (x[0], x[-1]), (y[0], y[-1]))
+    assert ret['peak'] == pytest.approx(5., rel=1e-3)
+    assert ret['flux'] == pytest.approx(5. * 2 * np.pi * sx * sy, rel=1e-3)
+    assert ret['centroid_x'] == pytest.approx(2e-4, rel=1e-6)
+    assert ret['centroid_y'] == pytest.approx(-1e-4, rel=1e-6)
+    assert ret['rms_x'] == pytest.approx(sx, rel=1e-3)
+    assert ret['rms_y'] == pytest.approx(sy, rel=1e-3)
+    assert ret['fwhm_x'] == pytest.approx(2 * np.sqrt(2 * np.log(2)) * sx, rel=1e-3)
+    assert ret['fwhm_y'] == pytest.approx(2 * np.sqrt(2 * np.log(2)) * sy, rel=1e-3)
+
+    assert ret['mean'] == pytest.approx(data.mean())
+
+    # the pixel area in m^2 is converted to the mm^2 of the intensity
+    ret = beam_statistics(data, (x[0], x[-1]), (y[0], y[-1]), units=['eV', 'm', 'm', 'ph/s/.1%bw/mm^2'])
+    assert ret['flux'] == pytest.approx(5. * 2 * np.pi * sx * sy * 1e6, rel=1e-3)
+
+    spectrum = beam_statistics(data[150], (x[0], x[-1]))
+    assert spectrum['centroid_x'] == pytest.approx(2e-4, rel=1e-6)
+    assert np.isnan(spectrum['centroid_y'])
+
+
+def test_handler(srw_file):
+    filename, values = srw_file
+    np.testing.assert_allclose(SRWFileHandler(filename)(), values, rtol=1e-6)
+    assert SRWFileHandler(filename, ndim=1)().shape == (600,)
+
+
+def test_image_transform():
+    x = np.linspace(-1., 1., 30)
+    y = np.linspace(-2., 2., 20)
+    data = np.add.outer(y, x)  # value of each pixel is y + x
+    transform = ImageTransform(dtype='float32', binning=(2, 3), roi=(2, 18, 3, 27))
+    binned = transform(data)
+    assert binned.dtype == np.float32
+    assert binned.shape == (8, 8)
+    h, v = transform.extents((x[0], x[-1]), (y[0], y[-1]), data.shape)
+    # the extents are the coordinates of the centers of the first and last bins
+    np.testing.assert_allclose(binned[:, 0] - binned[0, 0], np.linspace(0, v[1] - v[0], 8), atol=1e-5)
+    np.testing.assert_allclose(binned[0], np.linspace(h[0], h[1], 8) + v[0], atol=1e-5)
+    assert transform.resource_kwargs() == {'dtype': 'float32', 'binning': [2, 3], 'roi': [2, 18, 3, 27]}
+    assert ImageTransform(**transform.resource_kwargs()).suffix == transform.suffix
+    assert transform.transformed_shape(data.shape) == (8, 8)
+    assert ImageTransform().is_identity
+    with pytest.raises(ValueError):
+        ImageTransform(binning=0)
+    # the roi must fit in the image
+    with pytest.raises(ValueError):
+        ImageTransform(roi=(0, 10, 25, 35))(data)
+    with pytest.raises(ValueError):
+        ImageTransform(roi=(0, 10, 25, 35)).extents((x[0], x[-1]), (y[0], y[-1]), data.shape)
+
+
+def test_handler_transform(srw_file):
+    filename, values = srw_file
+    kwargs = {'dtype': 'float32', 'binning': [2, 2], 'roi': [0, 10, 0, 20]}
+    data = SRWFileHandler(filename, **kwargs)()
+    assert data.dtype == np.float32
+    np.testing.assert_allclose(data, values[:10, :20].reshape(5, 2, 10, 2).mean(axis=(1, 3)), rtol=1e-5)
+    assert os.path.exists(sidecar_path(filename, transform=ImageTransform(**kwargs)))
+    assert SRWFileHandler(filename)().shape == (20, 30)
+
+
+def test_handler_region(srw_file, monkeypatch):
+    filename, values = srw_file
+    SRWFileHandler.cache.clear()
+    region = SRWFileHandler(filename)(region=(5, 10, 0, 4))
+    np.testing.assert_allclose(region, values[5:10, :4], rtol=1e-6)
+    assert SRWFileHandler.cache.stats()['entries'] == 0
+
+    pytest.importorskip('dask.array')
+    monkeypatch.setattr(SRWFileHandler, 'lazy', True)
+    monkeypatch.setattr(SRWFileHandler, 'chunks', (10, 10))
+    lazy = SRWFileHandler(filename)()
+    assert lazy.chunks == ((10, 10), (10, 10, 10))
+    np.testing.assert_allclose(lazy.compute(), values, rtol=1e-6)
+    assert SRWFileHandler(filename).get_file_list([{}]) == [filename]
+
+
+def test_container_handler(tmp_path, monkeypatch):
+    pytest.importorskip('h5py')
+    frames = np.arange(3 * 4 * 5, dtype=np.float64).reshape(3, 4, 5)
+    filename = str(tmp_path / 'frames.h5')
+    writer = SRWContainerWriter(filename, len(frames))
+    for i, frame in enumerate(frames):
+        writer.write(i, frame)
+    writer.close()
+
+    handler = SRWContainerHandler(filename)
+    np.testing.assert_array_equal(handler(frame=1), frames[1])
+    np.testing.assert_array_equal(handler(frame=2, region=(1, 3, 2, 5)), frames[2, 1:3, 2:5])
+    pytest.importorskip('dask.array')
+    monkeypatch.setattr(SRWContainerHandler, 'lazy', True)
+    np.testing.assert_array_equal(handler(frame=2, region=(1, 3, 2, 5)).compute(), frames[2, 1:3, 2:5])
+    handler.close()
+
+
+def test_handler_sidecar(srw_file):
+    filename, values = srw_file
+    first = SRWFileHandler(filename)()
+    assert os.path.exists(sidecar_path(filename))
+    second = SRWFileHandler(filename)()
+    assert isinstance(second, np.memmap)
+    np.testing.assert_array_equal(first, second)
+
+    # the sidecar is stale once the file changes
+    with open(filename, 'wb') as f:
+        f.write(srw_file_content((4240., 4240., 1, -1e-3, 1e-3, 30, -2e-3, 2e-3, 20), 2 * values))
+    os.utime(filename, ns=(0, 0))
+    np.testing.assert_allclose(SRWFileHandler(filename)(), 2 * values, rtol=1e-6)
+    assert os.stat(sidecar_path(filename)).st_mtime_ns == 0
+
+
+def test_handler_cache(srw_file, monkeypatch):
+    filename, values = srw_file
+    SRWFileHandler.cache.clear()
+    # the memory-mapped sidecars are not counted as held in memory
+    assert isinstance(SRWFileHandler(filename)(), np.memmap)
+    assert SRWFileHandler.cache.stats()['entries'] == 0
+
+    monkeypatch.setattr(SRWFileHandler, 'use_sidecar', False)
+    first = SRWFileHandler(filename)()
+    assert SRWFileHandler(filename)() is first
+    assert not first.flags.writeable
+    stats = SRWFileHandler.cache.stats()
+    assert stats['entries'] == 1
+    assert stats['bytes'] == values.nbytes
+
+
+def test_array_cache_eviction():
+    cache = ArrayCache(max_bytes=200)
+    for key in 'abc':
+        cache.put(key, np.zeros(10))
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    cache.put('d', np.zeros(10))
+    assert cache.get('c') is None
+    assert cache.stats()['bytes'] == 160
+    cache.resize(0)
+    assert cache.stats()['entries'] == 0
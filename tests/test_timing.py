@@ -0,0 +1,37 @@
+import pytest
+
+import timing
+from timing import PhaseTimings
+
+
+def test_phase_timings():
+    timings = PhaseTimings('test')
+    for duration in [0.01] * 98 + [1., 10.]:
+        timings.record('run', duration)
+    with timings.time('download'):
+        pass
+    summary = timings.summary()
+    assert set(summary) == {'run', 'download'}
+    assert summary['run']['count'] == 100
+    assert summary['run']['max'] == 10.
+    assert summary['run']['mean'] == pytest.approx(0.1198)
+    # the percentiles are the upper edges of the histogram buckets
+    assert 0.01 <= summary['run']['p50'] < 0.02
+    assert 1. <= summary['run']['p99'] < 2.
+    edges, counts = timings.histogram('run')
+    assert len(counts) == len(edges) + 1 and sum(counts) == 100
+
+
+def test_hook():
+    calls = []
+
+    def hook(name, phase, duration):
+        calls.append((name, phase, duration))
+
+    timing.add_hook(hook)
+    try:
+        PhaseTimings('det').record('read', 0.5)
+    finally:
+        timing.remove_hook(hook)
+    PhaseTimings('det').record('read', 0.5)
+    assert calls == [('det', 'read', 0.5)]
@@ -0,0 +1,145 @@
+import bisect
+import contextlib
+import copy
+import threading
+import time
+
+# upper edges of the histogram buckets in seconds, 4 per decade from 0.1 ms to 1000 s
+BUCKETS = tuple(10 ** (k / 4) for k in range(-16, 13))
+
+_hooks = []
+
+
+def add_hook(hook):
+    """
+    Registers hook(name, phase, duration) to be called for every recorded duration.
+
+    name is the name of the PhaseTimings recording it, e.g. the server of a
+    client or the name of a detector, and duration is in seconds.
+
+    Examples
+    --------
+    def log_slow(name, phase, duration):
+        if duration > 10:
+            print(f'{name}: {phase} took {duration:.1f} s')
+
+    timing.add_hook(log_slow)
+
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+class _Phase(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+        # the last bucket counts the durations above BUCKETS[-1]
+        self.counts = [0] * (len(BUCKETS) + 1)
+
+
+class PhaseTimings(object):
+    """
+    Thread-safe histograms of the durations of the phases of simulation runs.
+
+    Parameters
+    ----------
+    name: str, optional
+        Name passed to the hooks, see add_hook().
+
+    Examples
+    --------
+    timings = PhaseTimings('sirepo_det')
+    with timings.time('download'):
+        ...
+    timings.summary()['download']['p99']
+
+    """
+
+    def __init__(self, name=''):
+        self.name = name
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'PhaseTimings({!r}, phases={})'.format(self.name, sorted(self._phases))
+
+    def __getstate__(self):
+        # the lock can't be pickled, e.g. to pass a client to a spawned process
+        with self._lock:
+            state = self.__dict__.copy()
+            state['_phases'] = copy.deepcopy(self._phases)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, phase, duration):
+        """ Adds a duration in seconds to the histogram of phase. """
+        with self._lock:
+            p = self._phases.get(phase)
+            if p is None:
+                p = self._phases[phase] = _Phase()
+            p.count += 1
+            p.total += duration
+            p.min = min(p.min, duration)
+            p.max = max(p.max, duration)
+            p.counts[bisect.bisect_left(BUCKETS, duration)] += 1
+        for hook in list(_hooks):
+            hook(self.name, phase, duration)
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        """ Records the duration of the with block, even if it raises. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def histogram(self, phase):
+        """ Returns the upper edges of the buckets and the count of durations in each.
+        The last count is for the durations above the last edge. """
+        with self._lock:
+            return BUCKETS, list(self._phases[phase].counts)
+
+    def percentile(self, phase, q):
+        """ Returns an upper bound of the q-th percentile of the durations of phase,
+        the edge of its histogram bucket. """
+        with self._lock:
+            p = self._phases[phase]
+            rank = q / 100 * p.count
+            cumulative = 0
+            for edge, count in zip(BUCKETS + (p.max,), p.counts):
+                cumulative += count
+                if cumulative >= rank and count:
+                    return min(edge, p.max)
+            return p.max
+
+    def summary(self):
+        """ Returns the count, total, mean, min, max and percentiles of each phase. """
+        with self._lock:
+            phases = list(self._phases)
+        ret = {}
+        for phase in phases:
+            p = self._phases[phase]
+            ret[phase] = {'count': p.count,
+                          'total': p.total,
+                          'mean': p.total / p.count,
+                          'min': p.min,
+                          'max': p.max,
+                          'p50': self.percentile(phase, 50),
+                          'p90': self.percentile(phase, 90),
+                          'p99': self.percentile(phase, 99)}
+        return ret
+
+    def reset(self):
+        with self._lock:
+            self._phases.clear()